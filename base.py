@@ -1,7 +1,11 @@
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
 import torch
+import torchdiffeq
 from einops import rearrange
 from torch import nn
-from torchdiffeq import odeint_adjoint
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
 
 from basehelper import *
 
@@ -11,7 +15,18 @@ class Tinvariant_NLayerNN(NLayerNN):
         return super(Tinvariant_NLayerNN, self).forward(x)
 
 
+class Tinvariant_FusedNLayerNN(FusedNLayerNN):
+    def forward(self, t, x):
+        return super(Tinvariant_FusedNLayerNN, self).forward(x)
+
+
 class dfwrapper(nn.Module):
+    """
+    Vector field on flattened states, with the integrand of recf appended when given. Build one per solve when recf
+    draws noise: the noise is kept here, so the adjoint backward of a solve reuses the noise of its forward.
+    """
+    noise = None
+
     def __init__(self, df, shape, recf=None):
         super(dfwrapper, self).__init__()
         self.df = df
@@ -22,8 +37,20 @@ class dfwrapper(nn.Module):
         bsize = x.shape[0]
         if self.recf:
             x = x[:, :-self.recf.osize].reshape(bsize, *self.shape)
-            dx = self.df(t, x)
-            dr = self.recf(t, x, dx).reshape(bsize, -1)
+            needs_graph = getattr(self.recf, 'needs_graph', False)
+            # Jacobian regularizers differentiate dx w.r.t. x, also in the no-grad forward of the adjoint method,
+            # where x is a slice without grad_fn even if it requires grad
+            if needs_graph and (not torch.is_grad_enabled() or x.grad_fn is None):
+                x = x.detach().requires_grad_()
+            with torch.enable_grad() if needs_graph else nullcontext():
+                dx = self.df(t, x)
+                if needs_graph:
+                    if self.noise is None:
+                        self.noise = torch.randn_like(dx)
+                    dr = self.recf(t, x, dx, self.noise)
+                else:
+                    dr = self.recf(t, x, dx)
+                dr = dr.reshape(bsize, -1)
             dx = dx.reshape(bsize, -1)
             dx = torch.cat([dx, dr], dim=1)
         else:
@@ -32,10 +59,122 @@ class dfwrapper(nn.Module):
             dx = dx.reshape(bsize, -1)
         return dx
 
+    @property
+    def nfe(self):
+        return self.df.nfe
+
+    def adjoint_params(self):
+        return active_parameters(self)
+
+    def cache_coefficients(self):
+        return self.df.cache_coefficients() if hasattr(self.df, 'cache_coefficients') else nullcontext()
+
+
+class ODESolver:
+    """
+    Solver settings shared by the modules that call odeint.
+        tol: rtol and atol of adaptive methods
+        adjoint: True for odeint_adjoint, False to backprop through the solver, 'auto' to use the adjoint method
+            only when the estimated autograd graph of a solve exceeds adjoint_threshold bytes
+        method: torchdiffeq method name, e.g. 'dopri5' (default), 'bosh3', 'rk4', 'euler', 'implicit_adams'
+        options: extra solver options, 'step_size' sets the grid of fixed-grid methods
+        seminorm: leave the parameter adjoint out of the step size control of the adjoint solve
+    The adjoint solve only carries func.adjoint_params() when func defines it, see NODE.adjoint_params.
+    """
+    tol = tol
+    adjoint = True
+    method = None
+    options = None
+    seminorm = False
+    adjoint_threshold = 2 ** 28
+    graph_factor = 8  # tensors the size of the state kept by autograd per function evaluation
+    solve_nfe = 26  # NFE of the last solve, initial guess is a few dopri5 steps
+
+    def set_solver(self, tol=None, adjoint=None, method=None, step_size=None, options=None, seminorm=None):
+        """
+        Update solver settings, arguments left as None are unchanged.
+        e.g. model.ode_rnn.set_solver(method='rk4', step_size=0.25) for fixed cost inference.
+        """
+        if tol is not None:
+            self.tol = tol
+        if adjoint is not None:
+            assert adjoint in (True, False, 'auto'), 'adjoint should be True, False or \'auto\''
+            self.adjoint = adjoint
+        if method is not None:
+            self.method = method
+        if options is not None:
+            self.options = dict(options)
+        if step_size is not None:
+            self.options = dict(self.options or {}, step_size=step_size)
+        if seminorm is not None:
+            self.seminorm = seminorm
+        return self
+
+    def graph_bytes(self, x0):
+        """
+        Estimated autograd graph size of one solve when backpropagating through the solver
+        """
+        return self.solve_nfe * self.graph_factor * x0.numel() * x0.element_size()
+
+    def use_adjoint(self, x0):
+        if self.adjoint != 'auto':
+            return self.adjoint
+        if not torch.is_grad_enabled():
+            return False
+        return self.graph_bytes(x0) > self.adjoint_threshold
+
+    def grid(self, name, x):
+        """
+        Time grid buffer `name` on the device and dtype of the state x. Converted copies are cached, so a grid is
+        transferred once rather than inside every odeint call.
+        """
+        grid = getattr(self, name)
+        if grid.device == x.device and grid.dtype == x.dtype:
+            return grid
+        if not hasattr(self, 'grid_cache'):
+            self.grid_cache = dict()
+        key = (name, x.device, x.dtype)
+        cached = self.grid_cache.get(key)
+        if cached is None or cached[0] is not grid:
+            cached = self.grid_cache[key] = (grid, grid.to(device=x.device, dtype=x.dtype))
+        return cached[1]
+
+    def check_device(self, *tensors):
+        """
+        Raise early if inputs and parameters live on different devices instead of copying inside the solver.
+        """
+        param = next(self.parameters(), None)
+        device = param.device if param is not None else tensors[0].device
+        for tensor in tensors:
+            if tensor.device != device:
+                raise RuntimeError('{} is on {} but got an input on {}'.format(type(self).__name__, device,
+                                                                                tensor.device))
+
+    def adjoint_kwargs(self, func):
+        kwargs = dict()
+        if self.seminorm:
+            kwargs['adjoint_options'] = dict(self.options or {}, norm='seminorm')
+        if hasattr(func, 'adjoint_params'):
+            kwargs['adjoint_params'] = func.adjoint_params()
+        return kwargs
+
+    def integrate(self, func, x0, t):
+        if self.use_adjoint(x0):
+            odeint = partial(torchdiffeq.odeint_adjoint, **self.adjoint_kwargs(func))
+        else:
+            odeint = torchdiffeq.odeint
+        nfe = getattr(func, 'nfe', None)
+        with func.cache_coefficients() if hasattr(func, 'cache_coefficients') else nullcontext():
+            out = odeint(func, x0, t, rtol=self.tol, atol=self.tol, method=self.method, options=self.options)
+        if nfe is not None:
+            self.solve_nfe = func.nfe - nfe
+        return out
+
 
-class NODEintegrate(nn.Module):
+class NODEintegrate(ODESolver, nn.Module):
 
-    def __init__(self, df, shape=None, tol=tol, adjoint=True, evaluation_times=None, recf=None):
+    def __init__(self, df, shape=None, tol=tol, adjoint=True, evaluation_times=None, recf=None, method=None,
+                 step_size=None, options=None, seminorm=False):
         """
         Create an OdeRnnBase model
             x' = df(x)
@@ -44,12 +183,13 @@ class NODEintegrate(nn.Module):
         :param x0: initial condition.
             - if x0 is set to be nn.parameter then it can be trained.
             - if x0 is set to be nn.Module then it can be computed through some network.
+        :param method, step_size, options, seminorm: solver settings, see ODESolver
         """
         super().__init__()
         self.df = dfwrapper(df, shape, recf) if shape else df
-        self.tol = tol
-        self.odeint = torchdiffeq.odeint_adjoint if adjoint else torchdiffeq.odeint
-        self.evaluation_times = evaluation_times if evaluation_times is not None else torch.Tensor([0.0, 1.0])
+        self.set_solver(tol, adjoint, method, step_size, options, seminorm)
+        evaluation_times = evaluation_times if evaluation_times is not None else torch.Tensor([0.0, 1.0])
+        self.register_buffer('evaluation_times', torch.as_tensor(evaluation_times), persistent=False)
         self.shape = shape
         self.recf = recf
         if recf:
@@ -72,7 +212,8 @@ class NODEintegrate(nn.Module):
                 reczeros = torch.zeros_like(x0[:, :1])
                 reczeros = repeat(reczeros, 'b 1 -> b c', c=self.recf.osize)
                 x0 = torch.cat([x0, reczeros], dim=1)
-            out = odeint(self.df, x0, self.evaluation_times, rtol=self.tol, atol=self.tol)
+            func = dfwrapper(self.df.df, self.shape, self.recf) if self.recf else self.df  # per solve noise
+            out = self.integrate(func, x0, self.grid('evaluation_times', x0))
             if self.recf:
                 rec = out[-1, :, -self.recf.osize:]
                 out = out[:, :, :-self.recf.osize]
@@ -81,17 +222,13 @@ class NODEintegrate(nn.Module):
             else:
                 return out
         else:
-            out = odeint(self.df, x0, self.evaluation_times, rtol=self.tol, atol=self.tol)
+            out = self.integrate(self.df, x0, self.grid('evaluation_times', x0))
             return out
 
     @property
     def nfe(self):
         return self.df.nfe
 
-    def to(self, device, *args, **kwargs):
-        super().to(device, *args, **kwargs)
-        self.evaluation_times.to(device)
-
 
 class NODElayer(NODEintegrate):
     def forward(self, x0):
@@ -126,6 +263,10 @@ class ODERNN(nn.Module):
 
 
 class NODE(nn.Module):
+    rescales = True  # forward multiplies the vector field by elem_t, so a zero interval leaves the state unchanged
+    # Defaults of attributes added after the first release live on the class, so that pickled models load
+    df_dtype = None
+
     def __init__(self, df=None, **kwargs):
         super(NODE, self).__init__()
         self.__dict__.update(kwargs)
@@ -133,18 +274,43 @@ class NODE(nn.Module):
         self.nfe = 0
         self.elem_t = None
 
+    def eval_df(self, t, x):
+        """
+        Compute df(t, x). With df_dtype set (e.g. torch.bfloat16) df runs under autocast and the result is cast back,
+        so the solver state and its error estimates stay in the precision of x.
+        """
+        if self.df_dtype is None:
+            return self.df(t, x)
+        with torch.autocast(x.device.type, dtype=self.df_dtype):
+            out = self.df(t, x)
+        return out.to(x.dtype)
+
     def forward(self, t, x):
         self.nfe += 1
         if self.elem_t is None:
-            return self.df(t, x)
+            return self.eval_df(t, x)
         else:
-            return self.elem_t * self.df(self.elem_t, x)
+            return self.elem_t * self.eval_df(self.elem_t, x)
 
     def update(self, elem_t):
-        self.elem_t = elem_t.view(*elem_t.shape, 1)
+        self.elem_t = None if elem_t is None else elem_t.view(*elem_t.shape, 1)
+
+    def adjoint_params(self):
+        """
+        Parameters carried by the adjoint solve, frozen Parameter modules (e.g. HeavyBallNODE.corr) are left out.
+        """
+        return active_parameters(self)
+
+    def cache_coefficients(self):
+        """
+        Context in which constant coefficients of the vector field are computed once, entered for each solve.
+        """
+        return nullcontext()
 
 
 class SONODE(NODE):
+    rescales = False  # elem_t is not applied, every interval is integrated over [0, 1]
+
     def forward(self, t, x):
         """
         Compute [y y']' = [y' y''] = [y' df(t, y, y')]
@@ -154,13 +320,16 @@ class SONODE(NODE):
         """
         self.nfe += 1
         v = x[:, 1:, :]
-        out = self.df(t, x)
+        out = self.eval_df(t, x)
         return torch.cat((v, out), dim=1)
 
 
 class HeavyBallNODE(NODE):
-    def __init__(self, df, actv_h=None, gamma_guess=-3.0, gamma_act='sigmoid', corr=-100, corrf=True, sign=1):
-        super().__init__(df)
+    coef = None  # damping coefficients cached for the current solve
+
+    def __init__(self, df, actv_h=None, gamma_guess=-3.0, gamma_act='sigmoid', corr=-100, corrf=True, sign=1,
+                 df_dtype=None):
+        super().__init__(df, df_dtype=df_dtype)
         # Momentum parameter gamma
         self.gamma = Parameter([gamma_guess], frozen=False)
         self.gammaact = nn.Sigmoid() if gamma_act == 'sigmoid' else gamma_act
@@ -168,6 +337,7 @@ class HeavyBallNODE(NODE):
         self.sp = nn.Softplus()
         self.sign = sign # Sign of df
         self.actv_h = nn.Identity() if actv_h is None else actv_h # Activation for dh, GHBNODE only
+        # df_dtype: precision of df only, the damping terms and [h, m] stay in the state precision
 
     def forward(self, t, x):
         """
@@ -182,8 +352,9 @@ class HeavyBallNODE(NODE):
         self.nfe += 1 # 已经通过调试验证：只有在这个地方nfe(forward)才会增加;但是调用多少次是forward是完全由odeint自己决定的...?
         h, m = torch.split(x, 1, dim=1)
         dh = self.actv_h(- m)
-        dm = self.df(t, h) * self.sign - self.gammaact(self.gamma()) * m
-        dm = dm + self.sp(self.corr()) * h
+        gamma, corr = self.coefficients()
+        dm = self.eval_df(t, h) * self.sign - gamma * m
+        dm = dm + corr * h
         out = torch.cat((dh, dm), dim=1)
         if self.elem_t is None:
             return out
@@ -191,83 +362,316 @@ class HeavyBallNODE(NODE):
             return self.elem_t * out
 
     def update(self, elem_t):
-        self.elem_t = elem_t.view(*elem_t.shape, 1, 1)
+        self.elem_t = None if elem_t is None else elem_t.view(*elem_t.shape, 1, 1)
+
+    def coefficients(self):
+        """
+        Activated damping coefficients (gammaact(gamma), softplus(corr)), computed once per solve inside
+        cache_coefficients. The cache ends with the solve, so optimizer steps and freeze / unfreeze between solves
+        are always seen; the adjoint backward pass recomputes them per evaluation.
+        """
+        if self.coef is not None:
+            return self.coef
+        return self.gammaact(self.gamma()), self.sp(self.corr())
+
+    @contextmanager
+    def cache_coefficients(self):
+        if self.coef is not None:
+            yield
+            return
+        self.coef = self.coefficients()
+        try:
+            yield
+        finally:
+            self.coef = None
 
 
 HBNODE = HeavyBallNODE # Alias
 
 
-class ODE_RNN(nn.Module):
-    def __init__(self, ode, rnn, nhid, ic, rnn_out=False, both=False, tol=1e-7):
+def pack_series(t, x, lengths):
+    """
+    Pack padded variable length sequences for ODE_RNN.forward_packed
+    :param t: [time, batch]
+    :param x: [time, batch, ...]
+    :param lengths: length of each sequence, shape [batch]
+    :return: PackedSequence of t and of x, sorted by decreasing length and sharing batch_sizes
+    """
+    lengths = torch.as_tensor(lengths, dtype=torch.int64).cpu()
+    return (pack_padded_sequence(t, lengths, enforce_sorted=False),
+            pack_padded_sequence(x, lengths, enforce_sorted=False))
+
+
+class ODE_RNN(ODESolver, nn.Module):
+    max_groups = 8
+    # Defaults of attributes added after the first release live on the class, so that pickled models load
+    irregular = False
+    recf = None
+    reg = 0
+    reg_batch = 1
+
+    def __init__(self, ode, rnn, nhid, ic, rnn_out=False, both=False, tol=1e-7, adjoint=True, method=None,
+                 step_size=None, options=None, seminorm=False, irregular=False, recf=None):
+        """
+        :param irregular: integrate every sample over its elapsed time t[i] instead of over [0, 1] with the vector
+            field rescaled by t[i], see flow_irregular
+        :param recf: Regularizer integrated alongside the hidden state over the observation intervals while grad is
+            enabled, read with regularization()
+        """
         super().__init__()
         self.ode = ode
-        self.t = torch.Tensor([0, 1])
+        self.register_buffer('t', torch.Tensor([0, 1]), persistent=False)
         self.nhid = [nhid] if isinstance(nhid, int) else nhid
         self.rnn = rnn
-        self.tol = tol
         self.rnn_out = rnn_out
         self.ic = ic
         self.both = both
+        self.irregular = irregular
+        self.recf = recf
+        self.set_solver(tol, adjoint, method, step_size, options, seminorm)
 
-    def forward(self, t, x, multiforecast=None):
+    def set_regularizer(self, recf):
+        """
+        Set or remove (None) the Regularizer of the observation intervals
+        """
+        self.recf = recf
+        return self
+
+    def start_reg(self, batch):
+        self.reg = 0
+        self.reg_batch = batch
+
+    def regularization(self):
+        """
+        Weighted regularizer integrated over the intervals of the last forward pass, averaged over the batch
+        """
+        return self.reg / self.reg_batch
+
+    def solve(self, h, times):
+        """
+        Solve the cell from h [batch, *nhid] over times. With recf and grad enabled the regularizer is integrated in
+        the same solve, its weighted value at each time is returned as [len(times), batch], None otherwise.
+        """
+        if self.recf is None or not torch.is_grad_enabled():
+            return self.integrate(self.ode, h, times), None
+        bsize = len(h)
+        osize = self.recf.osize
+        x0 = torch.cat([h.reshape(bsize, -1), h.new_zeros(bsize, osize)], dim=1)
+        sol = self.integrate(dfwrapper(self.ode, self.nhid, self.recf), x0, times)
+        weights = sol.new_tensor(self.recf.weights())
+        return sol[:, :, :-osize].reshape(len(times), bsize, *self.nhid), (sol[:, :, -osize:] * weights).sum(2)
+
+    def add_reg(self, reg):
+        if reg is not None:
+            self.reg = self.reg + reg.sum()
+
+    def flow(self, h, elem_t):
+        """
+        Evolve hidden state h over one observation interval
+        :param h: [batch, *nhid]
+        :param elem_t: interval lengths, shape [batch]
+        :return: [batch, *nhid]
+        """
+        if self.irregular:
+            return self.flow_irregular(h, elem_t)
+        # For cells that rescale by elem_t, zero intervals (padding, repeated timestamps) leave h unchanged and only
+        # the rest of the batch is solved, at the cost of one host sync. Not while tracing for export, where the
+        # branch would be fixed by the example input.
+        if getattr(self.ode, 'rescales', False) and not torch.jit.is_tracing():
+            idx = (elem_t != 0).nonzero(as_tuple=True)[0]
+            if len(idx) == 0:
+                return h
+            if len(idx) < len(h):
+                self.ode.update(elem_t[idx])
+                sol, reg = self.solve(h[idx], self.grid('t', h))
+                self.add_reg(reg[-1] if reg is not None else None)
+                return h.index_put((idx,), sol[-1])
+        self.ode.update(elem_t)
+        sol, reg = self.solve(h, self.grid('t', h))
+        self.add_reg(reg[-1] if reg is not None else None)
+        return sol[-1]
+
+    @staticmethod
+    def interval(t, mask, i):
+        return t[i] if mask is None else t[i] * mask[i]
+
+    @staticmethod
+    def masked(mask, i, new, old):
+        """
+        new where mask[i] is set, old for the padded samples
+        """
+        if mask is None:
+            return new
+        return torch.where(mask[i].view(-1, *[1] * (new.dim() - 1)), new, old)
+
+    def flow_irregular(self, h, elem_t):
+        """
+        Evolve each sample over its own elapsed time. Samples sharing a gap are solved together over [0, gap], so a
+        batch of short gaps is not stepped at the pace of the longest one, and zero gaps are not integrated. With
+        more than max_groups distinct gaps, one solve over [0, max gap] is read out at each sample's end time.
+        """
+        self.ode.update(None)
+        gaps, inverse = torch.unique(elem_t.to(h.dtype), return_inverse=True)
+        zero = torch.zeros_like(gaps[:1])
+        if len(gaps) > self.max_groups:
+            times = gaps if gaps[0] == 0 else torch.cat([zero, gaps])
+            sol, reg = self.solve(h, times)
+            end = (inverse + (len(times) - len(gaps)), torch.arange(len(h), device=h.device))
+            self.add_reg(reg[end] if reg is not None else None)
+            return sol[end]
+        out = h
+        for i in range(len(gaps)):
+            if gaps[i] == 0:
+                continue
+            idx = (inverse == i).nonzero(as_tuple=True)[0]
+            sol, reg = self.solve(h[idx], torch.cat([zero, gaps[i:i + 1]]))
+            self.add_reg(reg[-1] if reg is not None else None)
+            if len(idx) == len(h):
+                return sol[-1]
+            out = out.index_put((idx,), sol[-1])
+        return out
+
+    def forward(self, t, x, multiforecast=None, mask=None):
         """
         --
         :param t: [time, batch]
         :param x: [time, batch, ...]
+        :param mask: [time, batch] bool, False marks padding steps which leave the hidden state unchanged
         :return: [time, batch, *nhid]
         """
+        self.check_device(t, x)
         n_t, n_b = t.shape
-        h_ode = torch.zeros(n_t + 1, n_b, *self.nhid, device=x.device)
-        h_rnn = torch.zeros(n_t + 1, n_b, *self.nhid, device=x.device)
-        if self.ic:
-            h_ode[0] = h_rnn[0] = self.ic(rearrange(x, 't b c -> b (t c)')).view(h_ode[0].shape)
+        self.start_reg(n_b)
+        # States are collected in lists and stacked, in-place writes to a preallocated buffer would break autograd
+        # through the solver (adjoint=False or 'auto')
+        zeros = torch.zeros(n_b, *self.nhid, device=x.device)
+        h0 = self.ic(rearrange(x, 't b c -> b (t c)')).view(zeros.shape) if self.ic else zeros
+        h_ode = [h0] + [zeros] * n_t
+        h_rnn = [h0] + [zeros] * n_t
         if self.rnn_out:
             for i in range(n_t):
-                self.ode.update(t[i])
-                h_ode[i] = odeint(self.ode, h_rnn[i], self.t, atol=self.tol, rtol=self.tol)[-1]
-                h_rnn[i + 1] = self.rnn(h_ode[i], x[i])
+                h_ode[i] = self.masked(mask, i, self.flow(h_rnn[i], self.interval(t, mask, i)), h_rnn[i])
+                h_rnn[i + 1] = self.masked(mask, i, self.rnn(h_ode[i], x[i]), h_ode[i])
             out = (h_rnn,)
         else:
             for i in range(n_t):
-                self.ode.update(t[i])
-                h_rnn[i] = self.rnn(h_ode[i], x[i])
-                h_ode[i + 1] = odeint(self.ode, h_rnn[i], self.t, atol=self.tol, rtol=self.tol)[-1]
+                h_rnn[i] = self.masked(mask, i, self.rnn(h_ode[i], x[i]), h_ode[i])
+                h_ode[i + 1] = self.masked(mask, i, self.flow(h_rnn[i], self.interval(t, mask, i)), h_rnn[i])
             out = (h_ode,)
 
         if self.both:
             out = (h_rnn, h_ode)
 
+        out = tuple(torch.stack(h, dim=0) for h in out)
+
         if multiforecast is not None:
             self.ode.update(torch.ones_like((t[0])))
-            forecast = odeint(self.ode, out[-1][-1], multiforecast * 1.0, atol=self.tol, rtol=self.tol)
+            forecast = self.integrate(self.ode, out[-1][-1], multiforecast.to(x.device, x.dtype))
             out = (*out, forecast)
 
         return out
 
+    def init_state(self, t=None, x=None, batch=1):
+        """
+        Streaming state (h_rnn, h_ode), each [batch, *nhid]. Warmed up on a history window when t, x are given
+        (needed for models with ic), zeros otherwise.
+        :param t: [time, batch]
+        :param x: [time, batch, ...]
+        """
+        if x is None:
+            assert not self.ic, 'Models with ic need a history window to start a stream'
+            h = torch.zeros(batch, *self.nhid, device=self.t.device)
+            return h, h
+        if self.ic:
+            h = self.ic(rearrange(x, 't b c -> b (t c)')).view(x.shape[1], *self.nhid)
+        else:
+            h = torch.zeros(x.shape[1], *self.nhid, device=x.device)
+        state = (h, h)
+        for i in range(len(t)):
+            state = self.step(state, t[i], x[i])
+        return state
+
+    def step(self, state, t, x):
+        """
+        Advance streaming states by one observation, one flow and one rnn jump, same as one step of forward
+        :param state: (h_rnn, h_ode) from init_state or step
+        :param t: [batch] interval since the previous observation
+        :param x: [batch, ...] new observation
+        :return: new (h_rnn, h_ode)
+        """
+        h_rnn, h_ode = state
+        if self.rnn_out:
+            h_ode = self.flow(h_rnn, t)
+            h_rnn = self.rnn(h_ode, x)
+        else:
+            h_rnn = self.rnn(h_ode, x)
+            h_ode = self.flow(h_rnn, t)
+        return h_rnn, h_ode
+
+    def forecast(self, state, multiforecast):
+        """
+        Forecast from streaming states at times multiforecast after the last observation
+        :return: [len(multiforecast), batch, *nhid], apply the model's output layer on top
+        """
+        h = state[0] if self.rnn_out else state[1]
+        self.ode.update(torch.ones(len(h), device=h.device, dtype=h.dtype))
+        return self.integrate(self.ode, h, multiforecast.to(h.device, h.dtype))
+
+    def forward_packed(self, t, x, h0=None):
+        """
+        Recurrence over packed variable length sequences (see pack_series). Sequences are sorted by length, so
+        finished ones drop out of the batch and no solver work is spent on padding.
+        :param t: PackedSequence of intervals
+        :param x: PackedSequence of observations with the same batch_sizes
+        :param h0: initial state [batch, *nhid] in the original batch order, zeros if None
+        :return: PackedSequence of the state after each observation (h_rnn if rnn_out, h_ode otherwise) and the
+            final state [batch, *nhid] of every sequence in the original order
+        """
+        if h0 is None and self.ic:
+            raise ValueError('ic needs fixed length windows, pass h0 for packed input')
+        batch_sizes = x.batch_sizes.tolist()
+        if h0 is None:
+            h = torch.zeros(batch_sizes[0], *self.nhid, device=x.data.device, dtype=x.data.dtype)
+        else:
+            h = h0 if x.sorted_indices is None else h0[x.sorted_indices]
+        self.check_device(t.data, x.data, h)
+        self.start_reg(len(h))
+        out = []
+        finished = []
+        offset = 0
+        for bs in batch_sizes:
+            if bs < len(h):
+                finished.append(h[bs:])
+                h = h[:bs]
+            t_i = t.data[offset:offset + bs]
+            x_i = x.data[offset:offset + bs]
+            if self.rnn_out:
+                h = self.rnn(self.flow(h, t_i), x_i)
+            else:
+                h = self.flow(self.rnn(h, x_i), t_i)
+            out.append(h)
+            offset += bs
+        final = torch.cat([h] + finished[::-1])
+        if x.unsorted_indices is not None:
+            final = final[x.unsorted_indices]
+        return PackedSequence(torch.cat(out), x.batch_sizes, x.sorted_indices, x.unsorted_indices), final
 
-class ODE_RNN_with_Grad_Listener(nn.Module):
-    def __init__(self, ode, rnn, nhid, ic, rnn_out=False, both=False, tol=1e-7):
-        super().__init__()
-        self.ode = ode
-        self.t = torch.Tensor([0, 1])
-        self.nhid = [nhid] if isinstance(nhid, int) else nhid
-        self.rnn = rnn
-        self.tol = tol
-        self.rnn_out = rnn_out
-        self.ic = ic
-        self.both = both
 
-    def forward(self, t, x, multiforecast=None, retain_grad=False):
+class ODE_RNN_with_Grad_Listener(ODE_RNN):
+    def forward(self, t, x, multiforecast=None, retain_grad=False, mask=None):
         """
         --
         :param t: [time, batch]
         :param x: [time, batch, ...]
+        :param mask: [time, batch] bool, False marks padding steps which leave the hidden state unchanged
         :return: [time, batch, *nhid]
         """
+        self.check_device(t, x)
         n_t, n_b = t.shape
+        self.start_reg(n_b)
         h_ode = [None] * (n_t + 1)
         h_rnn = [None] * (n_t + 1)
-        h_ode[-1] = h_rnn[-1] = torch.zeros(n_b, *self.nhid)
+        h_ode[-1] = h_rnn[-1] = torch.zeros(n_b, *self.nhid, device=x.device)
 
         if self.ic:
             h_ode[0] = h_rnn[0] = self.ic(rearrange(x, 't b c -> b (t c)')).view((n_b, *self.nhid))
@@ -275,15 +679,13 @@ class ODE_RNN_with_Grad_Listener(nn.Module):
             h_ode[0] = h_rnn[0] = torch.zeros(n_b, *self.nhid, device=x.device)
         if self.rnn_out:
             for i in range(n_t):
-                self.ode.update(t[i])
-                h_ode[i] = odeint(self.ode, h_rnn[i], self.t, atol=self.tol, rtol=self.tol)[-1]
-                h_rnn[i + 1] = self.rnn(h_ode[i], x[i])
+                h_ode[i] = self.masked(mask, i, self.flow(h_rnn[i], self.interval(t, mask, i)), h_rnn[i])
+                h_rnn[i + 1] = self.masked(mask, i, self.rnn(h_ode[i], x[i]), h_ode[i])
             out = (h_rnn,)
         else:
             for i in range(n_t):
-                self.ode.update(t[i])
-                h_rnn[i] = self.rnn(h_ode[i], x[i])
-                h_ode[i + 1] = odeint(self.ode, h_rnn[i], self.t, atol=self.tol, rtol=self.tol)[-1]
+                h_rnn[i] = self.masked(mask, i, self.rnn(h_ode[i], x[i]), h_ode[i])
+                h_ode[i + 1] = self.masked(mask, i, self.flow(h_rnn[i], self.interval(t, mask, i)), h_rnn[i])
             out = (h_ode,)
 
         if self.both:
@@ -293,7 +695,7 @@ class ODE_RNN_with_Grad_Listener(nn.Module):
 
         if multiforecast is not None:
             self.ode.update(torch.ones_like((t[0])))
-            forecast = odeint(self.ode, out[-1][-1], multiforecast * 1.0, atol=self.tol, rtol=self.tol)
+            forecast = self.integrate(self.ode, out[-1][-1], multiforecast.to(x.device, x.dtype))
             out = (*out, forecast)
 
         if retain_grad:
@@ -7,13 +7,76 @@ class Zeronet(nn.Module):
 
 zeronet = Zeronet()
 
-class TVnorm(nn.Module):
-    def __init__(self):
-        super(TVnorm, self).__init__()
-        self.osize = 1
+class Regularizer(nn.Module):
+    """
+    Integrand of a regularizer solved alongside the state as recf of NODEintegrate or ODE_RNN.
+    forward(t, x, dx, e) returns [batch, osize] from the state x and its derivative dx; weight scales the integral in
+    penalty and ODE_RNN.regularization. With needs_graph, e is noise shaped like dx, drawn once per solve.
+    """
+    osize = 1
+    needs_graph = False  # dx has to be differentiable w.r.t. x
+
+    def __init__(self, weight=1.0):
+        super().__init__()
+        self.weight = weight
+
+    def weights(self):
+        return [self.weight] * self.osize
+
+    def penalty(self, rec):
+        """
+        Weighted batch mean of the integrated regularizer rec [batch, osize] returned by NODEintegrate
+        """
+        return (rec * rec.new_tensor(self.weights())).sum(1).mean()
+
+
+class TVnorm(Regularizer):
+    """
+    Total variation, L1 norm of dx per sample
+    """
+
+    def forward(self, t, x, v, e=None):
+        return v.reshape(v.shape[0], -1).abs().sum(1, keepdim=True)
+
+
+class KineticEnergy(Regularizer):
+    """
+    Squared L2 norm of dx per sample, favours straight trajectories that adaptive solvers take in few steps
+    """
+
+    def forward(self, t, x, v, e=None):
+        return v.reshape(v.shape[0], -1).pow(2).sum(1, keepdim=True)
 
-    def forward(self, t, x, v):
-        return torch.norm(v, 1)
+
+class JacobianFrobenius(Regularizer):
+    """
+    Squared Frobenius norm of the Jacobian d(dx)/dx per sample, by the Hutchinson estimator |e^T J|^2 with
+    e ~ N(0, I). e is drawn by the dfwrapper of each solve and reused by its adjoint backward, so the augmented
+    dynamics are the same in both directions.
+    """
+    needs_graph = True
+
+    def forward(self, t, x, v, e=None):
+        vjp = torch.autograd.grad(v, x, e, create_graph=True)[0]
+        return vjp.reshape(v.shape[0], -1).pow(2).sum(1, keepdim=True)
+
+
+class RegularizerList(Regularizer):
+    """
+    Several regularizers integrated in one augmented solve, each with its own weight
+    """
+
+    def __init__(self, *regularizers):
+        super().__init__()
+        self.regularizers = nn.ModuleList(regularizers)
+        self.osize = sum(r.osize for r in regularizers)
+        self.needs_graph = any(r.needs_graph for r in regularizers)
+
+    def weights(self):
+        return [w for r in self.regularizers for w in r.weights()]
+
+    def forward(self, t, x, v, e=None):
+        return torch.cat([r(t, x, v, e) for r in self.regularizers], dim=1)
 
 
 class NormAct(nn.Module):
@@ -33,13 +96,13 @@ class Parameter(nn.Module):
     def __init__(self, val, frozen=False):
         super().__init__()
         val = torch.Tensor(val)
-        self.val = val
+        # Buffer so that .to() moves the frozen value once, not persistent to keep state_dict keys unchanged
+        self.register_buffer('val', val, persistent=False)
         self.param = nn.Parameter(val)
         self.frozen = frozen
 
     def forward(self):
         if self.frozen:
-            self.val = self.val.to(self.param.device)
             return self.val
         else:
             return self.param
@@ -52,4 +115,12 @@ class Parameter(nn.Module):
         self.frozen = False
 
     def __repr__(self):
-        return "val: {}, param: {}".format(self.val.cpu(), self.param.detach().cpu())
\ No newline at end of file
+        return "val: {}, param: {}".format(self.val.cpu(), self.param.detach().cpu())
+
+
+def active_parameters(module):
+    """
+    Parameters of module that require grad, excluding those of frozen Parameter modules which are used as constants.
+    """
+    frozen = set(id(m.param) for m in module.modules() if isinstance(m, Parameter) and m.frozen)
+    return tuple(p for p in module.parameters() if p.requires_grad and id(p) not in frozen)
@@ -0,0 +1,211 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+# Batching over the batch axis of [time, batch, ...] series
+
+
+def gap_difficulty(times):
+    """
+    Total elapsed time of each window, a cost proxy for ODE-RNNs since solver steps grow with the intervals
+    :param times: [time, batch]
+    :return: [batch]
+    """
+    return torch.as_tensor(times).sum(0)
+
+
+def variance_difficulty(x):
+    """
+    Variance over time of each window averaged over features, a proxy for how hard the dynamics are
+    :param x: [time, batch, ...]
+    :return: [batch]
+    """
+    x = torch.as_tensor(x)
+    return x.var(0).reshape(x.shape[1], -1).mean(1)
+
+
+class BucketBatchSampler:
+    """
+    Yields index tensors of batches whose samples have similar cost, so that a batch is not paced by one hard sample.
+    Each epoch the difficulty scores are jittered by noise (relative to their spread), sorted and cut into batches,
+    and the batch order is shuffled, so batches still change between epochs.
+    Measured batch costs (see update) are split over the samples of the batch in proportion to the scores and kept
+    as a moving average per sample, which then replaces the scores for bucketing. A batch cost cannot tell its
+    samples apart beyond the scores, so with uninformative scores (e.g. gap_difficulty on the evenly spaced PV
+    windows) a sample's cost still depends on its bucket mates, averaged over the batches it was drawn in.
+    :param scores: difficulty per sample, shape [n], e.g. gap_difficulty(data.train_times)
+    :param batchsize: samples per batch
+    :param noise: jitter of the scores, 0 gives fixed buckets
+    :param momentum: weight of a new measurement in the moving average of the cost
+    :param seed: seed of the sampler's own random state
+    """
+
+    def __init__(self, scores, batchsize, noise=0.1, momentum=0.3, seed=0):
+        self.scores = torch.as_tensor(scores).detach().cpu().double().numpy().copy()
+        self.cost = np.full(len(self.scores), np.nan)
+        self.batchsize = batchsize
+        self.noise = noise
+        self.momentum = momentum
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return (len(self.scores) + self.batchsize - 1) // self.batchsize
+
+    def difficulty(self):
+        """
+        Measured cost per sample, samples not measured yet use their score rescaled to the measured ones
+        """
+        measured = ~np.isnan(self.cost)
+        if not measured.any():
+            return self.scores
+        scale = self.cost[measured].mean() / max(self.scores[measured].mean(), 1e-12)
+        return np.where(measured, self.cost, self.scores * scale)
+
+    def __iter__(self):
+        difficulty = self.difficulty()
+        key = difficulty + self.noise * (difficulty.std() + 1e-12) * self.rng.randn(len(difficulty))
+        order = np.argsort(key, kind='stable')
+        batches = [order[i:i + self.batchsize] for i in range(0, len(order), self.batchsize)]
+        for b in self.rng.permutation(len(batches)):
+            yield torch.from_numpy(np.sort(batches[b]))
+
+    def state_dict(self):
+        return dict(scores=self.scores.copy(), cost=self.cost.copy(), rng=self.rng.get_state())
+
+    def load_state_dict(self, state):
+        self.scores = state['scores'].copy()
+        self.cost = state['cost'].copy()
+        self.rng.set_state(state['rng'])
+
+    def update(self, indices, cost):
+        """
+        Record a measured cost of the batch of the given samples, e.g. its forward NFE
+        """
+        indices = torch.as_tensor(indices).cpu().numpy()
+        share = self.scores[indices]
+        share = share / share.mean() if share.mean() > 0 else np.ones(len(indices))
+        sample_cost = float(cost) * share
+        old = self.cost[indices]
+        self.cost[indices] = np.where(np.isnan(old), sample_cost,
+                                      (1 - self.momentum) * old + self.momentum * sample_cost)
+
+
+class BatchIterator:
+    """
+    Mini-batches of [time, batch, ...] arrays gathered along the batch axis, a drop-in for slice loops:
+        for idx, (t, x, y) in BatchIterator((data.train_times, data.train_x, data.train_y), batchsize=64):
+    Host sources are gathered on a background thread into pinned memory and copied to device without blocking, so
+    the next batch is prepared while the current one trains. Sources may be tensors or numpy arrays, including
+    np.memmap for data that does not fit in memory. Sources already on the target device are indexed in place.
+    :param tensors: sequence of [time, batch, ...] arrays with the same batch size
+    :param batchsize: samples per batch when no sampler is given, the order is a new permutation every epoch
+    :param sampler: iterable of index tensors, e.g. BucketBatchSampler
+    :param device: target device, defaults to the device of the first tensor
+    :param prefetch: batches gathered ahead
+    :param shuffle: permute samples every epoch when no sampler is given
+    """
+
+    def __init__(self, tensors, batchsize=None, sampler=None, device=None, prefetch=2, shuffle=True, seed=0):
+        assert (batchsize is None) != (sampler is None), 'Give one of batchsize and sampler'
+        self.tensors = list(tensors)
+        self.n = self.tensors[0].shape[1]
+        self.batchsize = batchsize
+        self.sampler = sampler
+        first = self.tensors[0]
+        self.device = torch.device(device if device is not None else
+                                   (first.device if isinstance(first, torch.Tensor) else 'cpu'))
+        self.prefetch = prefetch
+        self.shuffle = shuffle
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __len__(self):
+        if self.sampler is not None:
+            return len(self.sampler)
+        return (self.n + self.batchsize - 1) // self.batchsize
+
+    def state_dict(self):
+        state = dict(generator=self.generator.get_state())
+        if self.sampler is not None and hasattr(self.sampler, 'state_dict'):
+            state['sampler'] = self.sampler.state_dict()
+        return state
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'])
+        if 'sampler' in state:
+            self.sampler.load_state_dict(state['sampler'])
+
+    def indices(self):
+        if self.sampler is not None:
+            yield from self.sampler
+            return
+        order = torch.randperm(self.n, generator=self.generator) if self.shuffle else torch.arange(self.n)
+        for i in range(0, self.n, self.batchsize):
+            yield order[i:i + self.batchsize]
+
+    def on_device(self, src):
+        return isinstance(src, torch.Tensor) and src.device == self.device
+
+    def gather(self, idx):
+        """
+        Host side part of a batch: sources not on the target device, pinned when the target is a GPU
+        """
+        out = []
+        for src in self.tensors:
+            if self.on_device(src):
+                out.append(None)
+                continue
+            if isinstance(src, torch.Tensor):
+                batch = src.index_select(1, idx.to(src.device))
+            else:
+                batch = torch.from_numpy(np.ascontiguousarray(src[:, idx.numpy()]))
+            if self.device.type == 'cuda':
+                batch = batch.pin_memory()
+            out.append(batch)
+        return out
+
+    @staticmethod
+    def put(batches, item, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer(self, batches, stop):
+        try:
+            for idx in self.indices():
+                idx = torch.as_tensor(idx, dtype=torch.int64).cpu()
+                if not self.put(batches, (idx, self.gather(idx)), stop):
+                    return
+        except Exception as e:
+            self.put(batches, e, stop)
+        else:
+            self.put(batches, None, stop)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.producer, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                idx, host = item
+                out = []
+                for src, batch in zip(self.tensors, host):
+                    if batch is None:
+                        out.append(src.index_select(1, idx.to(src.device)))
+                    else:
+                        out.append(batch.to(self.device, non_blocking=True))
+                yield idx, tuple(out)
+        finally:
+            stop.set()
+            thread.join()
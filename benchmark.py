@@ -0,0 +1,286 @@
+"""
+Performance checks on random inputs shaped like the plane vibration task.
+Usage: python3 benchmark.py name
+"""
+
+from base import *
+
+
+def pv_model(name='hbnode'):
+    import importlib
+    module = importlib.import_module('plane_vibration.{}_rnn_pv'.format(name))
+    torch.manual_seed(0)
+    return module.MODEL(), module.seqlen
+
+
+def walker_model(name='hbnode'):
+    import importlib
+    module = importlib.import_module('walker2d.{}_rnn_walker'.format(name))
+    torch.manual_seed(0)
+    return module.MODEL(), module.seqlen
+
+
+def walker_batch(seqlen, batchsize=256):
+    t = torch.randint(1, 4, (seqlen, batchsize)) / 64.0
+    x = torch.randn(seqlen, batchsize, 17)
+    return t, x
+
+
+def pv_batch(seqlen, batchsize=64, forelen=8):
+    t = torch.ones(seqlen, batchsize)
+    x = torch.randn(seqlen, batchsize, 5)
+    return t, x, torch.arange(forelen)
+
+
+def bench_solver(repeats=3):
+    """
+    NFE and forward time of the HBNODE PV model under different solver settings.
+    """
+    settings = [
+        ('dopri5', dict(method='dopri5')),
+        ('bosh3', dict(method='bosh3')),
+        ('rk4 h=0.5', dict(method='rk4', step_size=0.5)),
+        ('rk4 h=0.25', dict(method='rk4', step_size=0.25)),
+        ('euler h=0.1', dict(method='euler', step_size=0.1)),
+    ]
+    model, seqlen = pv_model('hbnode')
+    t, x, fore = pv_batch(seqlen)
+    with torch.no_grad():
+        reference = model(t, x, multiforecast=fore)[-1]
+        for name, setting in settings:
+            model.ode_rnn.set_solver(options={}, **setting)
+            model.cell.nfe = 0
+            start_time = time.time()
+            for _ in range(repeats):
+                out = model(t, x, multiforecast=fore)[-1]
+            elapsed = (time.time() - start_time) / repeats
+            err = torch.max(torch.abs(out - reference)).item()
+            print(str_rec(['solver', 'nfe', 'time', 'max_err'],
+                          [name, model.cell.nfe // repeats, elapsed, err], ['', '', 's', '']))
+
+
+def bench_adjoint(repeats=3):
+    """
+    Forward / backward cost of adjoint and direct backprop on the HBNODE PV model.
+    Peak memory is exact on GPU; on CPU it is the process max RSS, so modes are run from small to large graph.
+    """
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model, seqlen = pv_model('hbnode')
+    model = shrink_parameters(model, 0.01).to(device)  # as in trainpv, the unshrunk model underflows dt in backward
+    t, x, fore = (i.to(device) for i in pv_batch(seqlen))
+    for mode in [True, 'auto', False]:
+        model.ode_rnn.set_solver(adjoint=mode)
+        forward_time = backward_time = forward_nfe = backward_nfe = 0
+        reset_peak_memory(device)
+        for _ in range(repeats):
+            model.zero_grad()
+            model.cell.nfe = 0
+            start_time = time.time()
+            loss = sum(torch.mean(i ** 2) for i in model(t, x, multiforecast=fore))
+            forward_time += time.time() - start_time
+            forward_nfe += model.cell.nfe
+            model.cell.nfe = 0
+            start_time = time.time()
+            loss.backward()
+            backward_time += time.time() - start_time
+            backward_nfe += model.cell.nfe
+        print(str_rec(['adjoint', 'forward_time', 'backward_time', 'forward_nfe', 'backward_nfe', 'peak_memory'],
+                      [mode, forward_time / repeats, backward_time / repeats, forward_nfe // repeats,
+                       backward_nfe // repeats, peak_memory(device)], ['', 's', 's', '', '', 'MB']))
+
+
+def bench_seminorm(repeats=3):
+    """
+    Backward NFE of the HBNODE walker and PV models with and without seminorm error control of the adjoint solve.
+    """
+    for task in ['pv', 'walker']:
+        if task == 'pv':
+            model, seqlen = pv_model('hbnode')
+            t, x, fore = pv_batch(seqlen)
+            inputs, kwargs = (t, x), dict(multiforecast=fore)
+        else:
+            model, seqlen = walker_model('hbnode')
+            inputs, kwargs = walker_batch(seqlen), dict()
+        print('{}: adjoint_params {}'.format(task, [tuple(p.shape) for p in model.cell.adjoint_params()]))
+        for seminorm in [False, True]:
+            model.ode_rnn.set_solver(adjoint=True, seminorm=seminorm)
+            backward_time = backward_nfe = 0
+            for _ in range(repeats):
+                model.zero_grad()
+                out = model(*inputs, **kwargs)
+                out = out if isinstance(out, tuple) else (out,)
+                loss = sum(torch.mean(i ** 2) for i in out)
+                model.cell.nfe = 0
+                start_time = time.time()
+                loss.backward()
+                backward_time += time.time() - start_time
+                backward_nfe += model.cell.nfe
+            print(str_rec(['task', 'seminorm', 'backward_nfe', 'backward_time'],
+                          [task, seminorm, backward_nfe // repeats, backward_time / repeats], ['', '', '', 's']))
+
+
+def bench_precision(repeats=3):
+    """
+    HBNODE PV model with df in float32 and bfloat16: forward NFE (should stay close), time and forecast deviation.
+    """
+    model, seqlen = pv_model('hbnode')
+    t, x, fore = pv_batch(seqlen)
+    with torch.no_grad():
+        reference = model(t, x, multiforecast=fore)[-1]
+        for dtype in [None, torch.bfloat16]:
+            model.cell.df_dtype = dtype
+            model.cell.nfe = 0
+            start_time = time.time()
+            for _ in range(repeats):
+                out = model(t, x, multiforecast=fore)[-1]
+            elapsed = (time.time() - start_time) / repeats
+            err = torch.max(torch.abs(out - reference)).item()
+            print(str_rec(['df_dtype', 'nfe', 'time', 'max_err'],
+                          [dtype or torch.float32, model.cell.nfe // repeats, elapsed, err], ['', '', 's', '']))
+
+
+def bench_mlp(nhid=20, batchsize=64, repeats=20):
+    """
+    Tinvariant_NLayerNN against Tinvariant_FusedNLayerNN as the df of a HBNODE cell, timed inside a no-grad rk4 solve.
+    """
+    torch.manual_seed(0)
+    reference = Tinvariant_NLayerNN(nhid, nhid, nhid, nhid)
+    fused = Tinvariant_FusedNLayerNN(nhid, nhid, nhid, nhid)
+    fused.load_state_dict(reference.state_dict())
+    x0 = torch.randn(batchsize, 2, nhid)
+    outs = []
+    for name, df in [('NLayerNN', reference), ('FusedNLayerNN', fused)]:
+        layer = NODEintegrate(HeavyBallNODE(df), adjoint=False, method='rk4', step_size=0.01)
+        with torch.no_grad():
+            start_time = time.time()
+            for _ in range(repeats):
+                out = layer(x0)
+        elapsed = time.time() - start_time
+        outs.append(out)
+        print(str_rec(['df', 'nfe', 'time/nfe'], [name, layer.nfe, elapsed / layer.nfe * 1e6], ['', '', 'us']))
+    print('max_err: {}'.format(torch.max(torch.abs(outs[0] - outs[1])).item()))
+
+
+def bench_irregular(repeats=3):
+    """
+    HBNODE PV model on gaps of 0 to 3 steps, unit interval rescaling against integration over the actual gaps.
+    """
+    model, seqlen = pv_model('hbnode')
+    _, x, fore = pv_batch(seqlen)
+    t = torch.randint(0, 4, x.shape[:2]).float()
+    with torch.no_grad():
+        reference = model(t, x, multiforecast=fore)[-1]
+        for irregular in [False, True]:
+            model.ode_rnn.irregular = irregular
+            model.cell.nfe = 0
+            start_time = time.time()
+            for _ in range(repeats):
+                out = model(t, x, multiforecast=fore)[-1]
+            elapsed = (time.time() - start_time) / repeats
+            err = torch.max(torch.abs(out - reference)).item()
+            print(str_rec(['irregular', 'nfe', 'time', 'max_err'],
+                          [irregular, model.cell.nfe // repeats, elapsed, err], ['', '', 's', '']))
+
+
+def bench_regularizer(nhid=8, batchsize=8):
+    """
+    Forward / backward smoke check of every regularizer, adjoint on and off, on the shrunk HBNODE PV model (two
+    ODE_RNN steps onward, where the adjoint forward gets states that require grad) and on a NODEintegrate.
+    """
+    regularizers = [
+        ('TVnorm', lambda: TVnorm(0.01)),
+        ('KineticEnergy', lambda: KineticEnergy(0.01)),
+        ('JacobianFrobenius', lambda: JacobianFrobenius(0.01)),
+        ('RegularizerList', lambda: RegularizerList(KineticEnergy(0.01), JacobianFrobenius(0.01))),
+    ]
+    model, seqlen = pv_model('hbnode')
+    model = shrink_parameters(model, 0.01)
+    t, x, fore = pv_batch(seqlen, batchsize)
+    torch.manual_seed(0)
+    df = Tinvariant_NLayerNN(nhid, nhid, nhid)
+    x0 = torch.randn(batchsize, 2, nhid)
+    for name, regularizer in regularizers:
+        for adjoint in [True, False]:
+            model.zero_grad()
+            model.ode_rnn.set_solver(adjoint=adjoint).set_regularizer(regularizer())
+            model.cell.nfe = 0
+            loss = sum(torch.mean(i ** 2) for i in model(t, x, multiforecast=fore))
+            reg = model.ode_rnn.regularization()
+            (loss + reg).backward()
+            grads = [p.grad for p in model.parameters() if p.grad is not None]
+            assert torch.isfinite(reg) and grads and all(torch.isfinite(g).all() for g in grads), name
+
+            recf = regularizer()
+            layer = NODEintegrate(HeavyBallNODE(df), shape=[2, nhid], recf=recf, adjoint=adjoint)
+            df.zero_grad()
+            out, rec = layer(x0)
+            (torch.mean(out[-1] ** 2) + recf.penalty(rec)).backward()
+            assert all(torch.isfinite(p.grad).all() for p in df.parameters()), name
+            print(str_rec(['regularizer', 'adjoint', 'ode_rnn_reg', 'nfe', 'node_penalty'],
+                          [name, adjoint, reg.item(), model.cell.nfe, recf.penalty(rec).item()]))
+    model.ode_rnn.set_regularizer(None)
+
+
+def bench_legacy():
+    """
+    Whole-module pickles saved before solver settings, irregular, recf, df_dtype and coefficient caching were added
+    (e.g. the walker .mdl files): the attributes are dropped before pickling, as in those files, and the reloaded
+    model has to give the same forecast.
+    """
+    import io
+    added = ['adjoint', 'method', 'options', 'seminorm', 'irregular', 'recf', 'reg', 'reg_batch', 'df_dtype', 'coef']
+    for task, name in [('walker', 'hbnode'), ('walker', 'sonode'), ('pv', 'hbnode')]:
+        model, seqlen = walker_model(name) if task == 'walker' else pv_model(name)
+        t, x = walker_batch(seqlen, 16) if task == 'walker' else pv_batch(seqlen, 16)[:2]
+        with torch.no_grad():
+            reference = model(t, x)
+        for m in model.modules():
+            for key in added:
+                m.__dict__.pop(key, None)
+        buffer = io.BytesIO()
+        torch.save(model, buffer)
+        buffer.seek(0)
+        try:
+            loaded = torch.load(buffer, weights_only=False)
+        except TypeError:  # torch without weights_only
+            loaded = torch.load(buffer)
+        with torch.no_grad():
+            out = loaded(t, x)
+        err = torch.max(torch.abs(out - reference)).item()
+        assert err < 1e-5, '{} {}'.format(task, name)
+        print(str_rec(['task', 'model', 'max_err'], [task, name, err]))
+
+
+def bench_import(repeats=3):
+    """
+    Cold import time of the modelling modules in a fresh interpreter, and which heavy packages they pull in.
+    """
+    import subprocess
+    heavy = ['torchvision', 'matplotlib', 'imageio', 'pandas']
+    for module in ['torch', 'misc', 'base']:
+        code = 'import time; s = time.time(); import {}; e = time.time() - s; import sys; ' \
+               'print(e, [m for m in {} if m in sys.modules])'.format(module, heavy)
+        times = []
+        for _ in range(repeats):
+            out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+            elapsed, loaded = out.split(' ', 1)
+            times.append(float(elapsed))
+        print(str_rec(['module', 'import_time', 'heavy_loaded'], [module, min(times), loaded.strip()], ['', 's', '']))
+
+
+benchmarks = {
+    'solver': bench_solver,
+    'adjoint': bench_adjoint,
+    'seminorm': bench_seminorm,
+    'precision': bench_precision,
+    'mlp': bench_mlp,
+    'irregular': bench_irregular,
+    'regularizer': bench_regularizer,
+    'legacy': bench_legacy,
+    'import': bench_import,
+}
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    assert len(args) == 1, "Input format: python3 benchmark.py {}".format('|'.join(benchmarks))
+    benchmarks[args[0]]()
@@ -0,0 +1,102 @@
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """
+    Copy of a (nested) state with every tensor cloned to CPU, safe to write while training goes on
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = dict(torch=torch.get_rng_state(), numpy=np.random.get_state(), random=random.getstate())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(state, path):
+    """
+    torch.save to a temporary file next to path, then rename it over path, so that path always holds a complete
+    checkpoint even if the process is killed while writing
+    """
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Checkpointer:
+    """
+    Keeps the latest training state at path. The state is copied to CPU when save is called; with background=True
+    the file is written by a thread while training continues (at most one write in flight).
+    :param path: checkpoint file, overwritten atomically
+    :param every: epochs between checkpoints
+    :param background: write in a background thread
+    """
+
+    def __init__(self, path, every=1, background=False):
+        self.path = path
+        self.every = every
+        self.background = background
+        self.thread = None
+        self.error = None
+
+    def write(self, state):
+        try:
+            atomic_save(state, self.path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state):
+        self.wait()
+        state = snapshot(state)
+        if self.background:
+            self.thread = threading.Thread(target=self.write, args=(state,), daemon=False)
+            self.thread.start()
+        else:
+            self.write(state)
+            self.wait()
+
+    def load(self, map_location='cpu'):
+        """
+        :return: the saved state, None if there is no checkpoint yet
+        """
+        self.wait()
+        if not os.path.exists(self.path):
+            return None
+        try:
+            return torch.load(self.path, map_location=map_location, weights_only=False)
+        except TypeError:  # torch without weights_only
+            return torch.load(self.path, map_location=map_location)
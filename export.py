@@ -0,0 +1,73 @@
+"""
+Export a trained model to a TorchScript file that loads with torch alone.
+Usage: python3 export.py task model checkpoint output [horizon]
+"""
+
+import copy
+import json
+
+from base import *
+
+fixed_grid_methods = ('euler', 'midpoint', 'rk4')
+
+
+class ExportWrapper(nn.Module):
+    def __init__(self, model, horizon=None):
+        super().__init__()
+        self.model = model
+        self.register_buffer('multiforecast', torch.arange(horizon) if horizon else None)
+
+    def forward(self, t, x):
+        if self.multiforecast is None:
+            return self.model(t, x)
+        return self.model(t, x, multiforecast=self.multiforecast)
+
+
+def export(model, path, example_t, example_x, horizon=None, method='rk4', step_size=0.25):
+    """
+    Trace model(t, x[, multiforecast]) with every solver set to a fixed-grid method, which unrolls the integrator into
+    a static graph, and save it as TorchScript. The artifact is specialised to the example window length and to
+    horizon forecast steps.
+    :param example_t: [time, batch] intervals of an example input
+    :param example_x: [time, batch, ...] observations of an example input
+    :return: the traced module
+    """
+    if method not in fixed_grid_methods:
+        raise ValueError('Export needs a fixed-grid method, one of {}'.format(fixed_grid_methods))
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        if isinstance(module, ODESolver):
+            if getattr(module, 'irregular', False):
+                raise ValueError('Irregular mode groups samples by value and can not be traced')
+            module.set_solver(adjoint=False, method=method, step_size=step_size)
+    with torch.no_grad():
+        artifact = torch.jit.trace(ExportWrapper(model, horizon), (example_t, example_x), check_trace=False)
+    config = dict(method=method, step_size=step_size, horizon=horizon, window=example_t.shape[0])
+    artifact.save(path, _extra_files={'config.json': json.dumps(config)})
+    return artifact
+
+
+def load(path, device='cpu'):
+    """
+    Load an exported model without the training code
+    :return: module taking (t, x), and the export config
+    """
+    extra_files = {'config.json': ''}
+    artifact = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    return artifact, json.loads(extra_files['config.json'])
+
+
+if __name__ == '__main__':
+    from run import task_module
+    from serve import load_model
+
+    args = sys.argv[1:]
+    assert len(args) in (4, 5), "Input format: python3 export.py task model checkpoint output [horizon]"
+    task, name, checkpoint, output = args[:4]
+    model = load_model(task, name, checkpoint)
+    seqlen = task_module(task, name).seqlen
+    features = {'pv': 5, 'walker': 17}[task]
+    t = torch.ones(seqlen, 1)
+    x = torch.zeros(seqlen, 1, features)
+    export(model, output, t, x, horizon=int(args[4]) if len(args) == 5 else None)
+    print('Exported {} {} to {}'.format(task, name, output))
@@ -6,17 +6,9 @@ import numpy as np
 from einops import rearrange, repeat
 import time
 import torch.optim as optim
-import glob
-import imageio
-from math import pi
-from random import random
-from torch.utils.data import Dataset, DataLoader
-from torch.distributions import Normal
-from torchvision import datasets, transforms
 import sys
-from matplotlib import pyplot as plt
-import pickle
-import csv
+# Only light dependencies here since every model module star-imports misc;
+# plotting, torchvision and file format modules are imported by the scripts that use them.
 # Format [time, batch, diff, vector]
 
 tol = 1e-3
@@ -41,6 +33,24 @@ def gradnorm(model, p=2):
     return total_norm
 
 
+def reset_peak_memory(device=None):
+    device = torch.device(device if device is not None else 'cpu')
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device=None):
+    """
+    Peak memory in MB, allocator peak since the last reset_peak_memory on GPU. On CPU it is the max RSS over the
+    process lifetime, which reset_peak_memory cannot reset.
+    """
+    device = torch.device(device if device is not None else 'cpu')
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
 class ArgumentParser:
     def add_argument(self, str, type, default):
         setattr(self, str[2:], default)
@@ -79,68 +89,284 @@ class EmptyClass:
     pass
 
 
-class Recorder:
+# Process-wide dataset cache, {dataset_key: dataset object}
+_datasets = dict()
+
+
+def dataset_key(loader, *args, **kwargs):
+    """
+    Key of a loader call, by loader name so that it matches across processes. Pass loader arguments by keyword.
+    """
+    return '{}.{}'.format(loader.__module__, loader.__qualname__), args, tuple(sorted(kwargs.items()))
+
+
+def cached_dataset(loader, *args, **kwargs):
+    """
+    Load a dataset once per process, e.g. cached_dataset(Walker2dImitationData, seq_len=64, device=0).
+    Every caller gets the same object and tensors, which must be treated as read-only.
+    """
+    key = dataset_key(loader, *args, **kwargs)
+    if key not in _datasets:
+        _datasets[key] = loader(*args, **kwargs)
+    return _datasets[key]
+
+
+def share_datasets():
+    """
+    Move the cached CPU tensors to shared memory and return the cache, to be handed to worker processes
+    (torch.multiprocessing) and installed there by load_shared_datasets. CUDA tensors are shared through CUDA IPC.
+    """
+    for data in _datasets.values():
+        for value in vars(data).values():
+            if isinstance(value, torch.Tensor) and not value.is_cuda:
+                value.share_memory_()
+    return _datasets
+
+
+def load_shared_datasets(shared):
+    """
+    Worker process initializer: later cached_dataset calls with the same arguments return the shared tensors
+    """
+    _datasets.update(shared)
+
+
+def to_host(values):
+    """
+    Dict of numbers and tensors to floats, tensors copied to host with one transfer per device
+    """
+    out = {key: float(value) for key, value in values.items() if not isinstance(value, torch.Tensor)}
+    devices = dict()
+    for key, value in values.items():
+        if isinstance(value, torch.Tensor):
+            devices.setdefault(value.device, []).append(key)
+    for keys in devices.values():
+        host = torch.stack([values[key].float() for key in keys]).cpu().numpy()
+        out.update(zip(keys, host.tolist()))
+    return out
+
+
+class MetricSums:
+    """
+    Sums of per-batch metrics (loss, correct predictions, NFE) kept as tensors on their device, so adding a batch
+    does not sync. result() reads all sums at once; throughput() gives samples per second since reset().
+    """
+
     def __init__(self):
-        self.store = []
-        self.current = dict()
+        self.reset()
+
+    def reset(self):
+        self.sums = dict()
+        self.batches = 0
+        self.samples = 0
+        self.start_time = time.time()
+
+    def add(self, samples=0, **metrics):
+        for key, value in metrics.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach()
+            self.sums[key] = self.sums[key] + value if key in self.sums else value
+        self.batches += 1
+        self.samples += samples
+
+    def result(self):
+        return to_host(self.sums)
+
+    def throughput(self):
+        return self.samples / (time.time() - self.start_time)
+
+
+class Recorder:
+    """
+    Per-epoch metric log. Values set with rec[key] = value are averaged until capture().
+    Tensor values are summed on their device without a host sync; capture() copies all sums to host at once
+    (one sync per device) and stores the means as one row of preallocated float columns. Keys not set before a
+    capture are marked missing in a separate mask, so a NaN metric (e.g. a diverged loss) is kept as a value.
+    writecsv / writeparquet append the rows captured since their last call to the same file.
+    """
+
+    def __init__(self, capacity=64):
+        self.columns = dict()
+        self.present = dict()
+        self.rows = 0
+        self.capacity = capacity
+        self.sums = dict()
+        self.counts = dict()
+        self.written = dict()
+        self.parquet = dict()
 
     def __setitem__(self, key, value):
-        for method in ['detach', 'cpu', 'numpy']:
-            if hasattr(value, method):
-                value = getattr(value, method)()
-        if key in self.current:
-            self.current[key].append(value)
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float().mean()
+        elif isinstance(value, np.ndarray):
+            value = float(np.mean(value))
+        if key in self.sums:
+            self.sums[key] = self.sums[key] + value
+            self.counts[key] += 1
         else:
-            self.current[key] = [value]
+            self.sums[key] = value
+            self.counts[key] = 1
+
+    def column(self, key):
+        if key not in self.columns:
+            self.columns[key] = np.full(self.capacity, np.nan)
+            self.present[key] = np.zeros(self.capacity, dtype=bool)
+        return self.columns[key]
+
+    def grow(self):
+        self.capacity *= 2
+        for key, col in self.columns.items():
+            self.columns[key] = np.concatenate([col, np.full(self.capacity - len(col), np.nan)])
+            self.present[key] = np.concatenate([self.present[key], np.zeros(self.capacity - len(col), dtype=bool)])
 
     def capture(self, verbose=False):
-        for i in self.current:
-            self.current[i] = np.mean(self.current[i])
-        self.store.append(self.current.copy())
-        self.current = dict()
+        if self.rows == self.capacity:
+            self.grow()
+        for key, value in to_host(self.sums).items():
+            self.column(key)[self.rows] = value / self.counts[key]
+            self.present[key][self.rows] = True
+        self.rows += 1
+        self.sums = dict()
+        self.counts = dict()
+        row = self.row(self.rows - 1)
         if verbose:
-            for i in self.store[-1]:
+            for i in row:
                 if i[0] != '_':
-                    print('{}: {}'.format(i, self.store[-1][i]))
-        return self.store[-1]
-
-    def tolist(self):
-        labels = set()
-        labels = sorted(labels.union(*self.store))
-        outlist = []
-        for obs in self.store:
-            outlist.append([obs.get(i, np.nan) for i in labels])
+                    print('{}: {}'.format(i, row[i]))
+        return row
+
+    def row(self, i):
+        return {key: col[i] for key, col in self.columns.items() if self.present[key][i]}
+
+    def state_dict(self):
+        return dict(columns={key: col[:self.rows].copy() for key, col in self.columns.items()},
+                    present={key: mask[:self.rows].copy() for key, mask in self.present.items()}, rows=self.rows)
+
+    def load_state_dict(self, state):
+        """
+        Restore the captured rows; files are rewritten in full on their next write
+        """
+        self.rows = state['rows']
+        self.capacity = max(self.capacity, 2 * self.rows)
+        self.columns = dict()
+        self.present = dict()
+        for key, col in state['columns'].items():
+            self.column(key)[:self.rows] = col
+            self.present[key][:self.rows] = state['present'][key]
+        self.sums = dict()
+        self.counts = dict()
+        self.written = dict()
+
+    @property
+    def store(self):
+        return [self.row(i) for i in range(self.rows)]
+
+    def tolist(self, start=0):
+        """
+        :return: sorted labels and the rows from start on, missing values are None
+        """
+        labels = sorted(self.columns)
+        outlist = [[self.columns[key][i] if self.present[key][i] else None for key in labels]
+                   for i in range(start, self.rows)] if labels else []
         return labels, outlist
 
     def writecsv(self, writer):
-        labels, outlist = self.tolist()
-        if isinstance(writer, str):
-            outfile = open(writer, 'w')
+        """
+        :param writer: a csv writer, which gets the whole log, or a path, which gets the rows captured since the
+            last writecsv to it (the file is rewritten when new columns appeared)
+        """
+        import csv
+        if not isinstance(writer, str):
+            labels, outlist = self.tolist()
+            writer.writerow(labels)
+            writer.writerows(outlist)
+            return
+        labels, start = self.written.get(writer, (None, 0))
+        append = labels == sorted(self.columns)
+        labels, outlist = self.tolist(start if append else 0)
+        with open(writer, 'a' if append else 'w', newline='') as outfile:
             csvwriter = csv.writer(outfile)
-            csvwriter.writerow(labels)
-            csvwriter.writerows(outlist)
-            outfile.close()
-        else:
-            csvwriter = writer
-            csvwriter.writerow(labels)
+            if not append:
+                csvwriter.writerow(labels)
             csvwriter.writerows(outlist)
+        self.written[writer] = (labels, self.rows)
+
+    def writeparquet(self, path):
+        """
+        Append the rows captured since the last call as a row group of a parquet file (needs pyarrow).
+        The file is complete once close() is called.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        labels = sorted(self.columns)
+        writer, written_labels, start = self.parquet.get(path, (None, None, 0))
+        if written_labels != labels:
+            if writer is not None:
+                writer.close()
+            writer, start = None, 0
+        table = pa.table({i: pa.array(self.columns[i][start:self.rows], mask=~self.present[i][start:self.rows])
+                          for i in labels})
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+        self.parquet[path] = (writer, labels, self.rows)
+
+    def close(self):
+        for writer, _, _ in self.parquet.values():
+            writer.close()
+        self.parquet = dict()
 
 
 class NLayerNN(nn.Module):
     def __init__(self, *args, actv=nn.ReLU()):
         super().__init__()
         self.linears = nn.ModuleList()
-        for i in range(len(args)):
+        for i in range(len(args) - 1):
             self.linears.append(nn.Linear(args[i], args[i+1]))
         self.actv = actv
 
     def forward(self, x):
-        for i in range(self.layer_cnt):
-            x = self.linears[i](x)
-            if i < self.layer_cnt - 1:
+        last = self.layer_cnt - 1
+        for i, linear in enumerate(self.linears):
+            x = linear(x)
+            if i < last:
                 x = self.actv(x)
         return x
 
     @property
     def layer_cnt(self):
-        return len(self.linears)
\ No newline at end of file
+        return len(self.linears)
+
+
+class FusedNLayerNN(NLayerNN):
+    """
+    NLayerNN with a fused inference path. Without grad, hidden layers are computed by addmm into workspace buffers
+    reused across calls (kept for the last batch size / device / dtype only, so varying batch sizes do not pile up
+    buffers) and activated in place. The output layer always returns a new tensor since solvers keep the derivatives
+    of earlier stages.
+    Falls back to NLayerNN.forward when grad is enabled or actv has no in-place version.
+    """
+    inplace_actv = {nn.ReLU: torch.relu_, nn.Tanh: torch.tanh_, nn.Sigmoid: torch.sigmoid_}
+
+    def __init__(self, *args, actv=nn.ReLU()):
+        super().__init__(*args, actv=actv)
+        self.inplace = self.inplace_actv.get(type(actv))
+        self.workspace = None
+
+    def workspace_for(self, x):
+        key = (x.shape[0], x.device, x.dtype)
+        if self.workspace is None or self.workspace[0] != key:
+            self.workspace = (key, [torch.empty(x.shape[0], linear.out_features, device=x.device, dtype=x.dtype)
+                                    for linear in self.linears[:-1]])
+        return self.workspace[1]
+
+    def forward(self, x):
+        if torch.is_grad_enabled() or self.inplace is None:
+            return super().forward(x)
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        for linear, out in zip(self.linears, self.workspace_for(x)):
+            torch.addmm(linear.bias, x, linear.weight.t(), out=out)
+            x = self.inplace(out)
+        last = self.linears[-1]
+        x = torch.addmm(last.bias, x, last.weight.t())
+        return x.reshape(*shape[:-1], x.shape[-1])
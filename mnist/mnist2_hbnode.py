@@ -1,6 +1,7 @@
 from base import *
 from anode_data_loader import mnist
 from einops.layers.torch import Rearrange
+from mnist.mnist_train import train
 
 parser = ArgumentParser()
 parser.add_argument('--network', type=str, default='odenet')
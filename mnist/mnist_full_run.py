@@ -4,6 +4,7 @@ import sys
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 import argparse
 import csv
+import pickle
 
 from anode_data_loader import mnist
 from base import *
@@ -169,7 +170,7 @@ def model_gen(name, **kwargs):
 if __name__ == '__main__':
     names = ['node', 'anode', 'sonode', 'hbnode', 'ghbnode']
     rec_names = ["model", "test#", "train/test", "iter", "loss", "acc", "forwardnfe", "backwardnfe", "time/iter",
-                 "time_elapsed"]
+                 "time_elapsed", "throughput"]
     csvfile = open('../imgdat/outdat0.csv', 'w')
     writer = csv.writer(csvfile)
     writer.writerow(rec_names)
@@ -1,106 +1,117 @@
 from misc import *
+from trainer import Task, Trainer
 
 rec_names = ["model", "test#", "train/test", "iter", "loss", "acc", "forwardnfe", "backwardnfe", "time/iter",
-             "time_elapsed"]
-rec_unit = ["", "", "", "", "", "", "", "", "s", "min"]
+             "time_elapsed", "throughput"]
+rec_unit = ["", "", "", "", "", "", "", "", "s", "min", "images/s"]
 import csv
 
 
-# only for training mnist dataset
-def train(model, optimizer, trdat, tsdat, args, modelname, testnumber=0, evalfreq=1, lrscheduler=False,
-          csvname='outdat.csv', stdout=sys.stdout, **extraprint):
-    defaultout = sys.stdout
-    sys.stdout = stdout
-    print("==> Train model {}, params {}".format(type(model), count_parameters(model)))
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    print("==> Use accelerator: ", device)
-    epoch = 0
-    itrcnt = 0
-    loss_func = nn.CrossEntropyLoss()
-    itr_arr = np.zeros(args.niters)
-    loss_arr = np.zeros(args.niters)
-    nfe_arr = np.zeros(args.niters)
-    time_arr = np.zeros(args.niters)
-    acc_arr = np.zeros(args.niters)
-    forward_nfe_arr = np.zeros(args.niters)
+class MNISTTask(Task):
+    """
+    Classification of the MNIST loaders, writing one csv row per epoch and per test in the format of rec_names.
+    Models returning (prediction, regularizer) get 0.1 * mean(regularizer) added to the loss.
+    """
+    batch_axis = 0
+
+    def __init__(self, trdat, tsdat, args, modelname, testnumber, evalfreq, csvname):
+        self.trdat = trdat
+        self.tsdat = tsdat
+        self.args = args
+        self.modelname = modelname
+        self.testnumber = testnumber
+        self.evalfreq = evalfreq
+        self.csvname = csvname
+        self.loss_func = nn.CrossEntropyLoss()
+        self.correct = MetricSums()
+        self.tested = None
+        self.start_time = time.time()
+        self.itr_arr, self.loss_arr, self.nfe_arr, self.time_arr, self.acc_arr = np.zeros((5, args.niters))
+
+    def batches(self):
+        self.correct.reset()
+        return ((None, batch) for batch in self.trdat)
 
-    # training
-    start_time = time.time()
-    while epoch < args.niters:
-        epoch += 1
-        iter_start_time = time.time()
-        acc = 0
-        for x, y in trdat:
-            itrcnt += 1
-            model[1].df.nfe = 0
-            optimizer.zero_grad()
+    def loss(self, model, batch, recorder):
+        x, y = batch
+        y = y.to(device=self.args.gpu)
+        # forward in time and solve ode
+        pred_y = model(x.to(device=self.args.gpu))
+        if isinstance(pred_y, tuple):
+            pred_y, rec = pred_y
+            # compute loss
+            loss = self.loss_func(pred_y, y) + 0.1 * torch.mean(rec)
+        else:
+            loss = self.loss_func(pred_y, y)
+        recorder['loss'] = loss
+        self.correct.add(y.shape[0], acc=torch.sum((torch.argmax(pred_y, dim=1) == y).float()))
+        return loss
+
+    def evaluate(self, model, recorder, epoch):
+        self.tested = None
+        if (epoch + 1) % self.evalfreq != 0:
+            return
+        model[1].df.nfe = 0
+        test_time = time.time()
+        metrics = MetricSums()
+        for x, y in self.tsdat:
             # forward in time and solve ode
-            pred_y = model(x.to(device=args.gpu))
+            y = y.to(device=self.args.gpu)
+            pred_y = model(x.to(device=self.args.gpu))
             if isinstance(pred_y, tuple):
                 pred_y, rec = pred_y
-                # compute loss
-                loss = loss_func(pred_y, y.to(device=args.gpu)) + 0.1 * torch.mean(rec)
-            else:
-                loss = loss_func(pred_y, y.to(device=args.gpu))
-            forward_nfe_arr[epoch - 1] += model[1].df.nfe
+            pred_l = torch.argmax(pred_y, dim=1)
+            # compute loss
+            metrics.add(y.shape[0], loss=self.loss_func(pred_y, y) * y.shape[0], acc=torch.sum((pred_l == y).float()))
+        sums = metrics.result()
+        self.tested = [sums['loss'] / 10000, sums['acc'] / 10000, model[1].df.nfe / len(self.tsdat),
+                       time.time() - test_time, metrics.throughput()]
+
+    def state_dict(self):
+        return dict(arrays=np.stack([self.itr_arr, self.loss_arr, self.nfe_arr, self.time_arr, self.acc_arr]))
 
-            loss.backward()
-            nn.utils.clip_grad_norm_(model.parameters(), 10.0)
-            optimizer.step()
-            # make arrays
-            itr_arr[epoch - 1] = epoch
-            loss_arr[epoch - 1] += loss.detach().cpu().numpy()
-            nfe_arr[epoch - 1] += model[1].df.nfe
-            acc += torch.sum((torch.argmax(pred_y, dim=1) == y.to(device=args.gpu)).float())
-        if lrscheduler:
-            lrscheduler.step()
-        iter_end_time = time.time()
-        time_arr[epoch - 1] = iter_end_time - iter_start_time
-        loss_arr[epoch - 1] *= 1.0 * epoch / itrcnt
-        nfe_arr[epoch - 1] *= 1.0 * epoch / itrcnt
-        forward_nfe_arr[epoch - 1] *= 1.0 * epoch / itrcnt
-        backwardnfe = nfe_arr[epoch - 1] - forward_nfe_arr[epoch - 1]
-        acc = acc.detach().cpu().numpy() / 60000
-        printouts = [modelname, testnumber, 'train', epoch,
-                     loss_arr[epoch - 1], acc, forward_nfe_arr[epoch - 1],
-                     backwardnfe, time_arr[epoch - 1],
-                     (time.time() - start_time) / 60]
-        csvfile = open(csvname, 'a')
+    def load_state_dict(self, state):
+        self.itr_arr, self.loss_arr, self.nfe_arr, self.time_arr, self.acc_arr = state['arrays'].copy()
+
+    def write(self, printouts):
+        csvfile = open(self.csvname, 'a')
         writer = csv.writer(csvfile)
         writer.writerow(printouts)
         csvfile.close()
         print(str_rec(rec_names, printouts, rec_unit))
-        if time_arr[epoch - 1] > 2400:
-            break
-        if epoch % evalfreq == 0:
-            model[1].df.nfe = 0
-            test_time = time.time()
-            loss = 0
-            acc = 0
-            bcnt = 0
-            for x, y in tsdat:
-                # forward in time and solve ode
-                y = y.to(device=args.gpu)
-                pred_y = model(x.to(device=args.gpu))
-                if isinstance(pred_y, tuple):
-                    pred_y, rec = pred_y
-                pred_l = torch.argmax(pred_y, dim=1)
-                acc += torch.sum((pred_l == y).float())
-                bcnt += 1
-                # compute loss
-                loss += loss_func(pred_y, y) * y.shape[0]
-            test_time = time.time() - test_time
-            loss = loss.detach().cpu().numpy() / 10000
-            acc = acc.detach().cpu().numpy() / 10000
-            printouts = [modelname, testnumber, 'test', epoch,
-                         loss, acc, model[1].df.nfe / len(tsdat),
-                         0, test_time,
-                         (time.time() - start_time) / 60]
-            csvfile = open(csvname, 'a')
-            writer = csv.writer(csvfile)
-            writer.writerow(printouts)
-            csvfile.close()
-            print(str_rec(rec_names, printouts, rec_unit))
-            acc_arr[epoch - 1] = acc
+
+    def epoch_end(self, trainer, epoch):
+        row = trainer.row
+        i = epoch
+        self.itr_arr[i] = epoch + 1
+        self.loss_arr[i] = row['loss']
+        self.nfe_arr[i] = row['forward_nfe'] + row['backward_nfe']
+        self.time_arr[i] = row['train_time']
+        acc = self.correct.result()['acc'] / 60000
+        elapsed = (time.time() - self.start_time) / 60
+        self.write([self.modelname, self.testnumber, 'train', epoch + 1, row['loss'], acc, row['forward_nfe'],
+                    row['backward_nfe'], row['train_time'], elapsed, row['throughput']])
+        if self.time_arr[i] > 2400:
+            trainer.stop = True
+        if self.tested is not None:
+            loss, acc, nfe, test_time, throughput = self.tested
+            self.write([self.modelname, self.testnumber, 'test', epoch + 1, loss, acc, nfe, 0, test_time, elapsed,
+                        throughput])
+            self.acc_arr[i] = acc
+
+
+# only for training mnist dataset
+def train(model, optimizer, trdat, tsdat, args, modelname, testnumber=0, evalfreq=1, lrscheduler=False,
+          csvname='outdat.csv', stdout=sys.stdout, checkpoint=None, budget=None,
+          **extraprint):
+    defaultout = sys.stdout
+    sys.stdout = stdout
+    print("==> Train model {}, params {}".format(type(model), count_parameters(model)))
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    print("==> Use accelerator: ", device)
+    task = MNISTTask(trdat, tsdat, args, modelname, testnumber, evalfreq, csvname)
+    trainer = Trainer(model, task, optimizer=optimizer, scheduler=lrscheduler or None, clip=10.0, cell=model[1].df,
+                      verbose=False, checkpoint=checkpoint, budget=budget)
+    trainer.fit(args.niters)
     sys.stdout = defaultout
-    return itr_arr, loss_arr, nfe_arr, time_arr, acc_arr
+    return task.itr_arr, task.loss_arr, task.nfe_arr, task.time_arr, task.acc_arr
@@ -75,8 +75,8 @@ class MODEL(nn.Module):
         return out
 
 
-def main():
+def main(data=None):
     model = MODEL()
     model.load_state_dict(torch.load('output/pv_anode_rnn.mdl'))
     trainpv(model, 'output/pv_log_an0_{}.csv'.format(count_parameters(model)), 'output/pv_anode_rnn.mdl', niter=40,
-            pre_shrink=1)
+            pre_shrink=1, data=data)
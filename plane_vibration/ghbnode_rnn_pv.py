@@ -65,6 +65,6 @@ class MODEL(nn.Module):
         return out
 
 
-def main():
+def main(data=None):
     model = MODEL()
-    trainpv(model, 'output/pv_log_ghb0_{}.csv'.format(count_parameters(model)), 'output/pv_ghbnode_rnn.mdl')
+    trainpv(model, 'output/pv_log_ghb0_{}.csv'.format(count_parameters(model)), 'output/pv_ghbnode_rnn.mdl', data=data)
@@ -59,6 +59,6 @@ class MODEL(nn.Module):
         return out
 
 
-def main():
+def main(data=None):
     model = MODEL()
-    trainpv(model, 'output/pv_log_n0_{}.csv'.format(count_parameters(model)), 'output/pv_node_rnn.mdl')
+    trainpv(model, 'output/pv_log_n0_{}.csv'.format(count_parameters(model)), 'output/pv_node_rnn.mdl', data=data)
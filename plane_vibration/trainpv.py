@@ -1,5 +1,7 @@
 from base import *
+from batching import BatchIterator, BucketBatchSampler, gap_difficulty
 from pvdat import pv
+from trainer import Task, Trainer, listener_grads
 
 seqlen = 64
 forelen = 8
@@ -12,93 +14,74 @@ def fcriteria(a, b):
     return d2.mean(dim=1)
 
 
-def trainpv(model, fname, mname, niter=500, lr_dict=None, gradrec=None, pre_shrink=0.01):
-    data = pv(input_len=seqlen, verbose=True, forecast_len=forelen)
+def load_data():
+    return cached_dataset(pv, input_len=seqlen, verbose=True, forecast_len=forelen)
+
+
+class PVTask(Task):
+    """
+    One step forecasting on the input window plus a forelen step forecast after it, trained on
+    0.1 * (prediction + initial state loss) + forecast loss. Logs to fname and saves the state_dict to mname.
+    """
+
+    def __init__(self, data, fname, mname, sampler=None, gradrec=None):
+        self.data = data
+        self.fname = fname
+        self.mname = mname
+        self.sampler = BucketBatchSampler(gap_difficulty(data.train_times), 64) if sampler is None else sampler
+        self.iterator = BatchIterator((data.train_times, data.train_x, data.train_y, data.trext), sampler=self.sampler)
+        self.gradrec = gradrec
+        self.criteria = nn.MSELoss()
+        self.forecast = torch.arange(forelen)
+
+    def loss(self, model, batch, recorder):
+        times, x, y, ext = batch
+        init, predict, forecast = model(times, x, multiforecast=self.forecast)
+        loss = self.criteria(predict, y)
+        loss = loss + self.criteria(init, x)
+        lossf = self.criteria(forecast, ext)
+        # recorder['train_loss'] = loss
+        recorder['train_forecast_loss'] = lossf
+
+        # Gradient backprop computation
+        if self.gradrec is not None:
+            for i, norm in enumerate(listener_grads(lossf, model.ode_rnn.h_ode)):
+                recorder['grad_{}'.format(i)] = norm
+        return loss * 0.1 + lossf
+
+    def evaluate(self, model, recorder, epoch):
+        data = self.data
+        sets = [('validation', 'validation_foreast_loss', data.valid_times, data.valid_x, data.vaext),
+                ('test', 'test_forecast_loss', data.test_times, data.test_x, data.tsext)]
+        for name, loss_name, times, x, ext in sets:
+            model.cell.nfe = 0
+            start_time = time.time()
+            init, predict, forecast = model(times, x, multiforecast=self.forecast)
+            recorder[loss_name] = fcriteria(forecast, ext)
+            recorder['{}_nfe'.format(name)] = model.cell.nfe
+            recorder['{}_time'.format(name)] = time.time() - start_time
+
+    def epoch_end(self, trainer, epoch):
+        print('Epoch {} complete.'.format(epoch))
+        if epoch % 20 == 0 or epoch + 1 == trainer.niter or trainer.stop:
+            trainer.recorder.writecsv(self.fname)
+            torch.save(trainer.model.state_dict(), self.mname)
+
+
+def trainpv(model, fname, mname, niter=500, lr_dict=None, gradrec=None, pre_shrink=0.01, sampler=None, data=None,
+            accumulate=1, checkpoint=None, budget=None, regularizer=None):
+    """
+    :param checkpoint: path or Checkpointer of the full training state, resumed from when it exists
+    :param budget: Budget, e.g. Budget(monitor='validation_foreast_loss', patience=20, max_time=3600)
+    :param regularizer: Regularizer set on model.ode_rnn, e.g. KineticEnergy(0.01), trained with reg_weight 1
+    """
+    data = load_data() if data is None else data
     lr_dict = {0: 0.001, 50: 0.0001} if lr_dict is None else lr_dict
-    recorder = Recorder()
     torch.manual_seed(0)
     model = shrink_parameters(model, pre_shrink)
-    criteria = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr_dict[0])
     print('Number of Parameters: {}'.format(count_parameters(model)))
-
-    for epoch in range(niter):
-
-        recorder['epoch'] = epoch
-
-        # Train
-        if epoch in lr_dict:
-            optimizer = torch.optim.Adam(model.parameters(), lr=lr_dict[epoch])
-
-        batchsize = 64
-        for b_n in range(0, data.train_x.shape[1], batchsize):
-            model.cell.nfe = 0
-            batch_start_time = time.time()
-            model.zero_grad()
-
-            # Forward pass
-            init, predict, forecast = model(data.train_times[:, b_n:b_n + batchsize],
-                                            data.train_x[:, b_n:b_n + batchsize],
-                                            multiforecast=torch.arange(forelen))
-            loss = criteria(predict, data.train_y[:, b_n:b_n + batchsize])
-            loss = loss + criteria(init, data.train_x[:, b_n:b_n + batchsize])
-            lossf = criteria(forecast, data.trext[:, b_n:b_n + batchsize])
-            total_loss = loss * 0.1 + lossf
-            recorder['forward_time'] = time.time() - batch_start_time
-            recorder['forward_nfe'] = model.cell.nfe
-            # recorder['train_loss'] = loss
-            recorder['train_forecast_loss'] = lossf
-
-            # Gradient backprop computation
-            if gradrec is not None:
-                lossf.backward(retain_graph=True)
-                vals = model.ode_rnn.h_ode
-                for i in range(len(vals)):
-                    recorder['grad_{}'.format(i)] = torch.norm(vals[i].grad)
-                model.zero_grad()
-
-            # Backward pass
-            model.cell.nfe = 0
-            total_loss.backward()
-            # recorder['model_gradient_2norm']= gradnorm(model)
-            # recorder['cell_gradient_2norm'] = gradnorm(model.cell)
-            # recorder['ic_gradient_2norm'] = gradnorm(model.ic)
-            nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            optimizer.step()
-            recorder['mean_batch_time'] = time.time() - batch_start_time
-            recorder['backward_nfe'] = model.cell.nfe
-
-        # Validation
-        if epoch == 0 or (epoch + 1) % 1 == 0:
-            model.cell.nfe = 0
-            validation_start_time = time.time()
-            init, predict, forecast = model(data.valid_times, data.valid_x, multiforecast=torch.arange(forelen))
-            vloss = criteria(predict, data.valid_y)
-            vloss = vloss + criteria(init, data.valid_x)
-            vloss = vloss.detach().cpu().numpy()
-            vfloss = fcriteria(forecast, data.vaext).detach().cpu().numpy()
-            # recorder['validation_loss'] = vloss
-            recorder['validation_foreast_loss'] = vfloss
-            recorder['validation_nfe'] = model.cell.nfe
-            recorder['validation_time'] = time.time() - validation_start_time
-
-        # Test
-        if epoch == 0 or (epoch + 1) % 1 == 0:
-            model.cell.nfe = 0
-            test_start_time = time.time()
-            init, predict, forecast = model(data.test_times, data.test_x, multiforecast=torch.arange(forelen))
-            sloss = criteria(predict, data.test_y)
-            sloss = sloss + criteria(init, data.test_x)
-            sloss = sloss.detach().cpu().numpy()
-            sfloss = fcriteria(forecast, data.tsext).detach().cpu().numpy()
-            # recorder['test_loss'] = sloss
-            recorder['test_forecast_loss'] = sfloss
-            recorder['test_nfe'] = model.cell.nfe
-            recorder['test_time'] = time.time() - test_start_time
-
-        recorder.capture(verbose=True)
-        print('Epoch {} complete.'.format(epoch))
-
-        if epoch % 20 == 0 or epoch == niter:
-            recorder.writecsv(fname)
-            torch.save(model.state_dict(), mname)
+    if regularizer is not None:
+        model.ode_rnn.set_regularizer(regularizer)
+    task = PVTask(data, fname, mname, sampler=sampler, gradrec=gradrec)
+    return Trainer(model, task, lr_dict=lr_dict, accumulate=accumulate, checkpoint=checkpoint,
+                   budget=budget, reg_weight=0. if regularizer is None else 1.).fit(niter)
@@ -1,35 +1,66 @@
-from plane_vibration import *
-from walker2d import *
+import importlib
 import sys
 
-run_pv = {
-    'node': node_rnn_pv.main,
-    'anode': anode_rnn_pv.main,
-    'sonode': sonode_rnn_pv.main,
-    'hbnode': hbnode_rnn_pv.main,
-    'ghbnode': ghbnode_rnn_pv.main,
+# Modules are only imported once their (task, model) is launched, so a PV run never loads walker data
+tasks = {
+    'pv': 'plane_vibration.{}_rnn_pv',
+    'walker': 'walker2d.{}_rnn_walker',
 }
 
-run_walker = {
-    'node': node_rnn_walker.main,
-    'anode': anode_rnn_walker.main,
-    'sonode': sonode_rnn_walker.main,
-    'hbnode': hbnode_rnn_walker.main,
-    'ghbnode': ghbnode_rnn_walker.main,
-}
+models = ['node', 'anode', 'sonode', 'hbnode', 'ghbnode']
+
+
+def pv_data():
+    from plane_vibration.trainpv import load_data
+    return load_data()
+
+
+def walker_data():
+    from misc import cached_dataset
+    from odelstm_data import Walker2dImitationData
+    return cached_dataset(Walker2dImitationData, seq_len=64, device=0)
+
 
-all_models = {
-    'pv': run_pv,
-    'walker': run_walker,
+datasets = {
+    'pv': pv_data,
+    'walker': walker_data,
 }
 
 
-def main(ds='pv', model='hbnode'):
-    all_models[ds][model]()
+def task_module(ds, model):
+    assert ds in tasks, 'Unknown task {}, choose from {}'.format(ds, list(tasks))
+    assert model in models, 'Unknown model {}, choose from {}'.format(model, models)
+    return importlib.import_module(tasks[ds].format(model))
+
+
+def entry_point(ds, model):
+    return task_module(ds, model).main
+
+
+def run_model(ds, model):
+    entry_point(ds, model)()
+
+
+def main(ds='pv', model='hbnode', workers=0):
+    """
+    :param model: a model name, or several separated by commas which are trained on one dataset loaded once
+    :param workers: train the models in this many worker processes, which receive the dataset in shared memory
+    """
+    names = model.split(',')
+    if workers <= 0:
+        for name in names:
+            run_model(ds, name)
+        return
+    import torch.multiprocessing as mp
+    from misc import load_shared_datasets, share_datasets
+    datasets[ds]()
+    with mp.get_context('spawn').Pool(workers, initializer=load_shared_datasets,
+                                      initargs=(share_datasets(),)) as pool:
+        pool.starmap(run_model, [(ds, name) for name in names])
 
 
 if __name__ == '__main__':
     args = sys.argv[1:]
-    assert len(args) == 2, "Input format: python3 run.py task model"
-    print("Working on dataset {} using {} model".format(*args))
-    main(*args)
+    assert len(args) in (2, 3), "Input format: python3 run.py task model[,model...] [workers]"
+    print("Working on dataset {} using {} model".format(*args[:2]))
+    main(*args[:2], workers=int(args[2]) if len(args) == 3 else 0)
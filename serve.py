@@ -0,0 +1,174 @@
+"""
+Local forecast server for trained PV / walker models.
+Usage: python3 serve.py task model checkpoint [port]
+    POST /forecast {"t": [time], "x": [time, feature], "horizon": 8} -> {"outputs": [...]}
+    GET /stats -> latency percentiles and throughput
+"""
+
+import collections
+import json
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from base import *
+from run import task_module
+
+
+def load_model(task, name, path, device='cpu'):
+    """
+    Load a checkpoint saved by trainpv (state_dict) or by the walker mains (whole module) into its MODEL class
+    """
+    module = task_module(task, name)
+    try:
+        state = torch.load(path, map_location=device, weights_only=False)
+    except TypeError:  # torch without weights_only
+        state = torch.load(path, map_location=device)
+    if isinstance(state, dict):
+        model = module.MODEL()
+        model.load_state_dict(state)
+    else:
+        model = state
+    return model.to(device).eval()
+
+
+class DynamicBatcher:
+    """
+    Collects concurrent forecast requests into one model call. A batch is run once max_batch requests are waiting
+    or max_latency seconds after its first request arrived. Requests are only batched with others of the same
+    window length and horizon.
+    :param model: MODEL taking (t [time, batch], x [time, batch, feature]) and multiforecast when horizon is set
+    """
+
+    def __init__(self, model, max_batch=64, max_latency=0.01, device='cpu', window=10000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.device = torch.device(device)
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.served = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, t, x, horizon=None):
+        """
+        :param t: [time] intervals
+        :param x: [time, feature] observations
+        :return: Future of the model outputs for this series, each [time, ...] without the batch axis
+        """
+        future = Future()
+        t = torch.as_tensor(t, dtype=torch.float32)
+        x = torch.as_tensor(x, dtype=torch.float32)
+        self.requests.put((time.time(), (t.shape[0], horizon), t, x, future))
+        return future
+
+    def collect(self):
+        first = self.requests.get()
+        pending = [first]
+        deadline = first[0] + self.max_latency
+        while len(pending) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        groups = collections.defaultdict(list)
+        for request in pending:
+            groups[request[1]].append(request)
+        return groups
+
+    def run(self):
+        while True:
+            for (_, horizon), group in self.collect().items():
+                try:
+                    outs = self.forward(group, horizon)
+                except Exception as e:
+                    for request in group:
+                        request[-1].set_exception(e)
+                    continue
+                done = time.time()
+                with self.lock:
+                    self.served += len(group)
+                    self.batch_sizes.append(len(group))
+                    self.latencies.extend(done - request[0] for request in group)
+                for i, request in enumerate(group):
+                    request[-1].set_result([out[:, i].cpu() for out in outs])
+
+    def forward(self, group, horizon):
+        t = torch.stack([request[2] for request in group], dim=1).to(self.device)
+        x = torch.stack([request[3] for request in group], dim=1).to(self.device)
+        with torch.no_grad():
+            if horizon:
+                outs = self.model(t, x, multiforecast=torch.arange(horizon, device=self.device))
+            else:
+                outs = self.model(t, x)
+        return outs if isinstance(outs, (tuple, list)) else (outs,)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            served = self.served
+        elapsed = time.time() - self.start_time
+        if len(latencies) == 0:
+            return dict(served=0)
+        return dict(served=served, p50_ms=float(np.percentile(latencies, 50)),
+                    p99_ms=float(np.percentile(latencies, 99)), throughput=served / elapsed,
+                    mean_batch=float(batch_sizes.mean()))
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.reply(200, batcher.stats())
+            else:
+                self.reply(404, dict(error='unknown path {}'.format(self.path)))
+
+        def do_POST(self):
+            if self.path != '/forecast':
+                self.reply(404, dict(error='unknown path {}'.format(self.path)))
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                outs = batcher.submit(request['t'], request['x'], request.get('horizon')).result()
+            except Exception as e:
+                self.reply(400, dict(error=str(e)))
+                return
+            self.reply(200, dict(outputs=[out.tolist() for out in outs]))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(task, name, path, port=8000, device='cpu', **kwargs):
+    batcher = DynamicBatcher(load_model(task, name, path, device), device=device, **kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(batcher))
+    print('Serving {} {} from {} on port {}'.format(task, name, path, port))
+    try:
+        server.serve_forever()
+    finally:
+        print(batcher.stats())
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    assert len(args) in (3, 4), "Input format: python3 serve.py task model checkpoint [port]"
+    serve(*args[:3], port=int(args[3]) if len(args) == 4 else 8000)
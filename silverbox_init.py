@@ -2,6 +2,8 @@
 Fig. 3
 """
 
+from matplotlib import pyplot as plt
+
 from base import *
 from sonode_data_loader import load_data
 
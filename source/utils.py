@@ -68,8 +68,8 @@ def cifar(batch_size=64, size=32, path_to_data='../cifar_data'):
     return train_loader, test_loader
 
 def train(model, optimizer, trdat, tsdat, args):
-    rec_names = ["iter", "loss", "acc", "nfe", "forwardnfe", "time/iter", "time"]
-    rec_unit = ["","","","","","s","min"]
+    rec_names = ["iter", "loss", "acc", "nfe", "forwardnfe", "time/iter", "time", "throughput"]
+    rec_unit = ["","","","","","s","min","images/s"]
     itrcnt = 0
     loss_func = nn.CrossEntropyLoss()
     itr_arr = np.zeros(args.niters)
@@ -84,6 +84,8 @@ def train(model, optimizer, trdat, tsdat, args):
     # training
     start_time = time.time()
     for epoch in range(1, args.niters+1):
+        # loss / accuracy summed on device, read once per epoch
+        loss_sum = 0
         acc = 0
         dsize = 0
         iter_start_time = time.time()
@@ -104,19 +106,20 @@ def train(model, optimizer, trdat, tsdat, args):
             scheduler.step()
             # make arrays
             itr_arr[epoch - 1] = epoch
-            loss_arr[epoch - 1] += loss.detach()
+            loss_sum = loss_sum + loss.detach()
             nfe_arr[epoch - 1] += model[1].df.nfe
             # compute acc
             pred_l = torch.argmax(pred_y, dim=1)
             acc += torch.sum((pred_l == y).float())
             dsize += y.shape[0]
+        loss_sum, acc = torch.stack([loss_sum, acc]).cpu().numpy()
         iter_end_time = time.time()
         time_arr[epoch - 1] = iter_end_time - iter_start_time
-        loss_arr[epoch - 1] *= 1.0 * epoch / itrcnt
+        loss_arr[epoch - 1] = loss_sum * epoch / itrcnt
         nfe_arr[epoch - 1] *= 1.0 * epoch / itrcnt
         forward_nfe_arr[epoch - 1] *= 1.0 * epoch / itrcnt
-        acc = acc.detach().cpu().numpy() / dsize
-        printouts = [epoch, loss_arr[epoch-1], acc, nfe_arr[epoch-1], forward_nfe_arr[epoch - 1], time_arr[epoch-1], (time.time()-start_time)/60]
+        acc = acc / dsize
+        printouts = [epoch, loss_arr[epoch-1], acc, nfe_arr[epoch-1], forward_nfe_arr[epoch - 1], time_arr[epoch-1], (time.time()-start_time)/60, dsize / time_arr[epoch-1]]
         print(str_rec(rec_names, printouts, rec_unit, presets="Train|| {}"))
         outlist.append(printouts)
         writer.writerow(printouts)
@@ -127,20 +130,20 @@ def train(model, optimizer, trdat, tsdat, args):
             acc = 0
             dsize = 0
             bcnt = 0
-            for x, y in tsdat:
-                # forward in time and solve ode
-                dsize += y.shape[0]
-                y = y.to(device=args.gpu)
-                pred_y = model(x.to(device=args.gpu)).detach()
-                pred_l = torch.argmax(pred_y, dim=1)
-                acc += torch.sum((pred_l == y).float())
-                bcnt += 1
-                # compute loss
-                loss += loss_func(pred_y, y).detach() * y.shape[0]
+            with torch.no_grad():
+                for x, y in tsdat:
+                    # forward in time and solve ode
+                    dsize += y.shape[0]
+                    y = y.to(device=args.gpu)
+                    pred_y = model(x.to(device=args.gpu))
+                    pred_l = torch.argmax(pred_y, dim=1)
+                    acc += torch.sum((pred_l == y).float())
+                    bcnt += 1
+                    # compute loss
+                    loss += loss_func(pred_y, y) * y.shape[0]
+            loss, acc = (torch.stack([loss, acc]).cpu().numpy() / dsize).tolist()
             test_time = time.time() - test_start_time
-            loss /= dsize
-            acc /= dsize
-            printouts = [epoch, loss.detach().cpu().numpy(), acc.detach().cpu().numpy(), str(model[1].df.nfe / bcnt), None, test_time, (time.time()-start_time)/60]
+            printouts = [epoch, loss, acc, str(model[1].df.nfe / bcnt), None, test_time, (time.time()-start_time)/60, dsize / test_time]
             print(str_rec(rec_names, printouts, presets="Test || {}"))
             outlist.append(printouts)
             writer.writerow(printouts)
@@ -0,0 +1,81 @@
+from base import *
+
+
+class StreamStore:
+    """
+    Hidden states of many independent streams served by one ODE_RNN, kept in a contiguous [capacity, 2, *nhid]
+    tensor (h_rnn, h_ode per stream) with a stream id -> slot index and a free list of slots.
+    Streams that received data are gathered, advanced together by ODE_RNN.step with their own elapsed times (one
+    batched solve) and scattered back.
+    """
+
+    def __init__(self, ode_rnn, capacity=1024, device='cpu', dtype=torch.float32):
+        self.ode_rnn = ode_rnn
+        self.states = torch.zeros(capacity, 2, *ode_rnn.nhid, device=device, dtype=dtype)
+        self.slots = dict()
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, stream_id):
+        return stream_id in self.slots
+
+    def grow(self):
+        capacity = len(self.states)
+        self.states = torch.cat([self.states, torch.zeros_like(self.states)])
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, stream_id, state=None):
+        """
+        Register a stream, with zero state or a state (h_rnn, h_ode) from ODE_RNN.init_state without batch axis
+        """
+        if stream_id in self.slots:
+            raise KeyError('Stream {} already exists'.format(stream_id))
+        if not self.free:
+            self.grow()
+        slot = self.free.pop()
+        self.slots[stream_id] = slot
+        if state is None:
+            self.states[slot] = 0
+        else:
+            self.states[slot] = torch.stack(state)
+        return slot
+
+    def remove(self, stream_id):
+        self.free.append(self.slots.pop(stream_id))
+
+    def index(self, stream_ids):
+        return torch.as_tensor([self.slots[i] for i in stream_ids], dtype=torch.int64, device=self.states.device)
+
+    def state(self, stream_ids):
+        states = self.states[self.index(stream_ids)]
+        return states[:, 0], states[:, 1]
+
+    def advance(self, stream_ids, t, x):
+        """
+        Advance the given streams by one observation each. Unknown streams start from zero state unless the model
+        needs ic, in which case they have to be added with a warmed up state first.
+        :param stream_ids: ids of the streams with new data, without repeats
+        :param t: [n] time elapsed since each stream's previous observation
+        :param x: [n, ...] new observations
+        :return: new (h_rnn, h_ode), each [n, *nhid]
+        """
+        assert len(set(stream_ids)) == len(stream_ids), 'A stream can only advance once per call'
+        if not self.ode_rnn.ic:
+            for stream_id in stream_ids:
+                if stream_id not in self.slots:
+                    self.add(stream_id)
+        idx = self.index(stream_ids)
+        states = self.states[idx]
+        with torch.no_grad():
+            h_rnn, h_ode = self.ode_rnn.step((states[:, 0], states[:, 1]), t, x)
+        self.states[idx] = torch.stack([h_rnn, h_ode], dim=1)
+        return h_rnn, h_ode
+
+    def forecast(self, stream_ids, multiforecast):
+        """
+        :return: [len(multiforecast), n, *nhid] forecast of the given streams from their current states
+        """
+        with torch.no_grad():
+            return self.ode_rnn.forecast(self.state(stream_ids), multiforecast)
@@ -0,0 +1,369 @@
+from base import *
+from checkpoint import Checkpointer, rng_state, set_rng_state
+
+
+def lr_schedule(optimizer, lr_dict):
+    """
+    LambdaLR following an {epoch: lr} dict, each lr held until the next key. Unlike recreating the optimizer at
+    those epochs, this keeps the optimizer state.
+    """
+    epochs = sorted(lr_dict)
+
+    def factor(epoch):
+        passed = [i for i in epochs if i <= epoch]
+        return lr_dict[passed[-1] if passed else epochs[0]] / lr_dict[epochs[0]]
+
+    for group in optimizer.param_groups:
+        group['lr'] = lr_dict[epochs[0]]
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, factor)
+
+
+def listener_grads(loss, tensors):
+    """
+    Gradient norms of loss w.r.t. the hidden states kept by ODE_RNN_with_Grad_Listener, through autograd.grad so
+    that parameter gradients are left untouched. States the loss does not depend on give 0.
+    """
+    idx = [i for i, v in enumerate(tensors) if v.requires_grad]
+    grads = torch.autograd.grad(loss, [tensors[i] for i in idx], retain_graph=True, allow_unused=True)
+    norms = [0] * len(tensors)
+    for i, grad in zip(idx, grads):
+        norms[i] = 0 if grad is None else torch.norm(grad)
+    return norms
+
+
+class Task:
+    """
+    What the Trainer trains on. Subclasses give the batches, the loss of a batch and the evaluations.
+    Hooks record their metrics in the recorder given to them.
+    """
+    batch_axis = 1  # [time, batch, ...] series
+    sampler = None  # BucketBatchSampler to update with the forward NFE of each batch
+    iterator = None  # BatchIterator, checkpointed with its sampler
+
+    def batches(self):
+        """
+        :return: iterable of (idx, batch), batch being a tuple of tensors
+        """
+        return self.iterator
+
+    def loss(self, model, batch, recorder):
+        """
+        :return: scalar training loss of the batch
+        """
+        raise NotImplementedError
+
+    def evaluate(self, model, recorder, epoch):
+        """
+        Validation / test, run by the Trainer in eval mode without grad
+        """
+        pass
+
+    def regularizer(self, model):
+        """
+        Regularization of the last forward pass, added to the loss with weight Trainer.reg_weight. Defaults to the
+        regularization() of every ODE_RNN in the model that has a recf.
+        """
+        return sum(m.regularization() for m in ode_rnns(model) if m.recf is not None)
+
+    def epoch_end(self, trainer, epoch):
+        """
+        Called after the epoch's row was captured, e.g. to write logs and save the model; trainer.stop is set when
+        this is the last epoch of an early stopped run
+        """
+        pass
+
+    def state_dict(self):
+        return dict(iterator=self.iterator.state_dict()) if self.iterator is not None else dict()
+
+    def load_state_dict(self, state):
+        if 'iterator' in state:
+            self.iterator.load_state_dict(state['iterator'])
+
+
+def solvers(model):
+    return [m for m in model.modules() if isinstance(m, ODESolver)]
+
+
+def ode_rnns(model):
+    return [m for m in model.modules() if isinstance(m, ODE_RNN)]
+
+
+class Budget:
+    """
+    Bounds the cost of a run from the epoch records of a Trainer.
+    Stops on a plateau of the monitored validation loss, or once the wall clock time or the cumulative NFE
+    (forward + backward, over resumes) is spent. When the mean forward NFE per batch exceeds nfe_threshold, the
+    tolerance of every ODESolver in the model is loosened by tol_factor (up to max_tol), every ODE_RNN without a
+    recf gets one made by regularizer, and the regularizer weight is raised to reg_init or multiplied by reg_factor
+    (up to max_reg); once it falls below nfe_threshold / 2 the tolerance is tightened back toward its starting value.
+    The weight is only raised when something is regularized: an ODE_RNN with a recf or a Task.regularizer override.
+    :param monitor: row key of the validation loss, e.g. 'va_loss'
+    :param patience: epochs without an improvement larger than min_delta before stopping, None to disable
+    :param max_time: seconds of training
+    :param max_nfe: cumulative NFE
+    :param nfe_threshold: mean forward NFE per batch, None to disable adaptation
+    :param regularizer: makes the Regularizer installed on ODE_RNNs without one, None to install none
+    """
+
+    def __init__(self, monitor=None, patience=None, min_delta=0., max_time=None, max_nfe=None, nfe_threshold=None,
+                 tol_factor=10., max_tol=1e-3, reg_init=0.01, reg_factor=2., max_reg=100., regularizer=KineticEnergy):
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_time = max_time
+        self.max_nfe = max_nfe
+        self.nfe_threshold = nfe_threshold
+        self.tol_factor = tol_factor
+        self.max_tol = max_tol
+        self.reg_init = reg_init
+        self.reg_factor = reg_factor
+        self.max_reg = max_reg
+        self.regularizer = regularizer
+        self.best = float('inf')
+        self.bad_epochs = 0
+        self.base_tol = None
+
+    def state_dict(self):
+        return dict(best=self.best, bad_epochs=self.bad_epochs, base_tol=self.base_tol)
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.bad_epochs = state['bad_epochs']
+        self.base_tol = state['base_tol']
+
+    def plateau(self, row):
+        if self.patience is None or self.monitor not in row:
+            return False
+        if row[self.monitor] < self.best - self.min_delta:
+            self.best = row[self.monitor]
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        return self.bad_epochs > self.patience
+
+    def adapt(self, trainer, row):
+        if self.nfe_threshold is None or 'forward_nfe' not in row:
+            return
+        models = solvers(trainer.model)
+        if self.base_tol is None:
+            self.base_tol = [m.tol for m in models]
+        if row['forward_nfe'] > self.nfe_threshold:
+            for m in models:
+                m.set_solver(tol=min(m.tol * self.tol_factor, max(self.max_tol, m.tol)))
+            if self.regularize(trainer):
+                trainer.reg_weight = min(max(trainer.reg_weight * self.reg_factor, self.reg_init), self.max_reg)
+                print('Forward NFE {} over {}: tol {}, reg_weight {}'.format(row['forward_nfe'], self.nfe_threshold,
+                                                                              [m.tol for m in models],
+                                                                              trainer.reg_weight))
+            else:
+                print('Forward NFE {} over {}: tol {}, nothing to regularize'.format(
+                    row['forward_nfe'], self.nfe_threshold, [m.tol for m in models]))
+        elif row['forward_nfe'] < self.nfe_threshold / 2:
+            for m, tol in zip(models, self.base_tol):
+                m.set_solver(tol=max(m.tol / self.tol_factor, tol))
+
+    def regularize(self, trainer):
+        """
+        Install regularizers on the ODE_RNNs without one
+        :return: whether task.regularizer has anything to weigh
+        """
+        rnns = ode_rnns(trainer.model)
+        if self.regularizer is not None:
+            for m in rnns:
+                if m.recf is None:
+                    m.set_regularizer(self.regularizer())
+        return any(m.recf is not None for m in rnns) or type(trainer.task).regularizer is not Task.regularizer
+
+    def update(self, trainer, row):
+        """
+        Called by the Trainer after each epoch, sets trainer.stop when the budget is spent
+        """
+        reasons = []
+        if self.plateau(row):
+            reasons.append('{} did not improve for {} epochs'.format(self.monitor, self.bad_epochs))
+        if self.max_time is not None and trainer.elapsed > self.max_time:
+            reasons.append('time budget {}s spent'.format(self.max_time))
+        if self.max_nfe is not None and trainer.total_nfe > self.max_nfe:
+            reasons.append('NFE budget {} spent'.format(self.max_nfe))
+        self.adapt(trainer, row)
+        if reasons:
+            print('Stopping at epoch {}: {}'.format(trainer.epoch, ', '.join(reasons)))
+            trainer.stop = True
+
+
+class Trainer:
+    """
+    Training loop shared by the PV, walker and MNIST experiments: one optimizer kept for the whole run with the
+    learning rate driven by a scheduler, gradient accumulation, gradient clipping, no-grad evaluation and per batch
+    timing, NFE and peak memory records.
+    :param model: model to train
+    :param task: Task
+    :param optimizer: defaults to Adam with lr 0.001
+    :param lr_dict: {epoch: lr}, turned into a LambdaLR unless scheduler is given, overrides the optimizer's lr
+    :param scheduler: learning rate scheduler stepped once per epoch
+    :param accumulate: batches per optimizer step
+    :param clip: max gradient norm, None to disable
+    :param cell: module with the nfe counter, defaults to model.cell
+    :param verbose: print each captured row
+    :param checkpoint: Checkpointer or path; fit resumes from it when it exists and saves to it every
+        checkpoint.every epochs
+    :param budget: Budget deciding when to stop and adapting solver tolerance and reg_weight
+    :param reg_weight: weight of task.regularizer(model) in the training loss, 0 leaves it out. It multiplies the
+        regularizers' own weights, so use 1 to train with those as set; a Budget raises it from 0 to reg_init
+    """
+
+    def __init__(self, model, task, optimizer=None, lr_dict=None, scheduler=None, recorder=None, accumulate=1,
+                 clip=1.0, cell=None, verbose=True, checkpoint=None, budget=None, reg_weight=0.):
+        self.model = model
+        self.task = task
+        self.optimizer = torch.optim.Adam(model.parameters(), lr=0.001) if optimizer is None else optimizer
+        if scheduler is None:
+            lr_dict = {0: self.optimizer.param_groups[0]['lr']} if lr_dict is None else lr_dict
+            scheduler = lr_schedule(self.optimizer, lr_dict)
+        self.scheduler = scheduler
+        self.recorder = Recorder() if recorder is None else recorder
+        self.accumulate = accumulate
+        self.clip = clip
+        self.cell = model.cell if cell is None else cell
+        self.device = next(model.parameters()).device
+        self.verbose = verbose
+        self.row = None
+        self.checkpoint = Checkpointer(checkpoint) if isinstance(checkpoint, str) else checkpoint
+        self.budget = budget
+        self.reg_weight = reg_weight
+        self.elapsed = 0.
+        self.total_nfe = 0
+        self.epoch = 0
+        self.niter = None
+        self.stop = False
+
+    @property
+    def nfe(self):
+        return self.cell.nfe
+
+    @nfe.setter
+    def nfe(self, value):
+        self.cell.nfe = value
+
+    def step(self):
+        if self.clip is not None:
+            nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+    def train_epoch(self):
+        rec = self.recorder
+        self.model.train()
+        self.optimizer.zero_grad()
+        train_start_time = time.time()
+        samples = 0
+        pending = 0
+        for idx, batch in self.task.batches():
+            self.nfe = 0
+            reset_peak_memory(self.device)
+            batch_start_time = time.time()
+
+            # Forward pass
+            loss = self.task.loss(self.model, batch, rec)
+            if self.reg_weight:
+                reg = self.task.regularizer(self.model)
+                if torch.is_tensor(reg):
+                    rec['regularizer'] = reg
+                    loss = loss + self.reg_weight * reg
+            rec['forward_time'] = time.time() - batch_start_time
+            rec['forward_nfe'] = self.nfe
+            self.total_nfe += self.nfe
+            if self.task.sampler is not None:
+                self.task.sampler.update(idx, self.nfe)
+
+            # Backward pass
+            self.nfe = 0
+            backward_start_time = time.time()
+            (loss / self.accumulate).backward()
+            pending += 1
+            if pending == self.accumulate:
+                self.step()
+                pending = 0
+            rec['backward_time'] = time.time() - backward_start_time
+            rec['backward_nfe'] = self.nfe
+            self.total_nfe += self.nfe
+            rec['mean_batch_time'] = time.time() - batch_start_time
+            if self.device.type == 'cuda':  # the CPU value is the process lifetime max RSS, not a per batch peak
+                rec['peak_memory'] = peak_memory(self.device)
+            samples += batch[0].shape[self.task.batch_axis]
+        if pending:
+            self.step()
+        train_time = time.time() - train_start_time
+        rec['train_time'] = train_time
+        rec['throughput'] = samples / train_time
+
+    def evaluate(self):
+        self.model.eval()
+        with torch.no_grad():
+            self.task.evaluate(self.model, self.recorder, self.epoch)
+
+    def state_dict(self):
+        return dict(model=self.model.state_dict(), optimizer=self.optimizer.state_dict(),
+                    scheduler=self.scheduler.state_dict(), epoch=self.epoch, recorder=self.recorder.state_dict(),
+                    task=self.task.state_dict(), rng=rng_state(), elapsed=self.elapsed, total_nfe=self.total_nfe,
+                    reg_weight=self.reg_weight, tol=[m.tol for m in solvers(self.model)],
+                    recf=[m.recf for m in ode_rnns(self.model)],
+                    budget=self.budget.state_dict() if self.budget is not None else None)
+
+    def load_state_dict(self, state):
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.epoch = state['epoch']
+        self.recorder.load_state_dict(state['recorder'])
+        self.task.load_state_dict(state['task'])
+        set_rng_state(state['rng'])
+        self.elapsed = state['elapsed']
+        self.total_nfe = state['total_nfe']
+        self.reg_weight = state['reg_weight']
+        for m, tol in zip(solvers(self.model), state['tol']):
+            m.set_solver(tol=tol)
+        for m, recf in zip(ode_rnns(self.model), state['recf']):  # e.g. installed by the Budget
+            if recf is not None:
+                m.set_regularizer(recf)
+        if self.budget is not None and state['budget'] is not None:
+            self.budget.load_state_dict(state['budget'])
+
+    def resume(self):
+        """
+        Load the latest checkpoint if there is one
+        :return: whether training state was restored
+        """
+        state = self.checkpoint.load()
+        if state is None:
+            return False
+        self.load_state_dict(state)
+        print('Resumed from {} at epoch {}'.format(self.checkpoint.path, self.epoch))
+        return True
+
+    def fit(self, niter):
+        """
+        Train until epoch niter, continuing from self.epoch or from the checkpoint
+        """
+        self.niter = niter
+        if self.checkpoint is not None and self.epoch == 0:
+            self.resume()
+        while self.epoch < niter and not self.stop:
+            epoch_start_time = time.time()
+            self.recorder['epoch'] = self.epoch
+            self.train_epoch()
+            self.scheduler.step()
+            self.evaluate()
+            self.elapsed += time.time() - epoch_start_time
+            self.recorder['total_nfe'] = self.total_nfe
+            self.row = self.recorder.capture(verbose=self.verbose)
+            if self.budget is not None:
+                self.budget.update(self, self.row)
+            self.task.epoch_end(self, self.epoch)
+            self.epoch += 1
+            if self.checkpoint is not None and (self.epoch % self.checkpoint.every == 0 or self.epoch == niter or
+                                                self.stop):
+                self.checkpoint.save(self.state_dict())
+        if self.checkpoint is not None:
+            self.checkpoint.wait()
+        return self.recorder
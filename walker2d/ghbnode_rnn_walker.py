@@ -1,9 +1,9 @@
 from base import *
 
 from odelstm_data import Walker2dImitationData
+from walker2d.trainwalker import trainwalker
 
 seqlen = 64
-data = Walker2dImitationData(seq_len=seqlen, device=0)
 
 
 class tempf(nn.Module):
@@ -60,8 +60,8 @@ class MODEL(nn.Module):
         return out
 
 
-def main():
-    data = Walker2dImitationData(seq_len=seqlen, device=0)
+def main(data=None):
+    data = cached_dataset(Walker2dImitationData, seq_len=seqlen, device=0) if data is None else data
     gradrec = True
     lr_dict = {0: 0.001, 50: 0.003}
     res = True
@@ -69,56 +69,4 @@ def main():
     torch.manual_seed(0)
     model = MODEL(res=res, cont=cont).to(0)
     modelname = 'GHBNODE'
-    print(model.__str__())
-    rec = Recorder()
-    criteria = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr_dict[0])
-    print('Number of Parameters: {}'.format(count_parameters(model)))
-    timelist = [time.time()]
-    for epoch in range(500):
-        rec['epoch'] = epoch
-        if epoch in lr_dict:
-            optimizer = torch.optim.Adam(model.parameters(), lr=lr_dict[epoch])
-
-        batchsize = 256
-        train_start_time = time.time()
-        for b_n in range(0, data.train_x.shape[1], batchsize):
-            model.cell.nfe = 0
-            predict = model(data.train_times[:, b_n:b_n + batchsize] / 64.0, data.train_x[:, b_n:b_n + batchsize])
-            loss = criteria(predict, data.train_y[:, b_n:b_n + batchsize])
-            rec['forward_nfe'] = model.cell.nfe
-            rec['loss'] = loss
-
-            # Gradient backprop computation
-            if gradrec is not None:
-                lossf = criteria(predict[-1], data.train_y[-1, b_n:b_n + batchsize])
-                lossf.backward(retain_graph=True)
-                vals = model.ode_rnn.h_rnn
-                for i in range(len(vals)):
-                    grad = vals[i].grad
-                    rec['grad_{}'.format(i)] = 0 if grad is None else torch.norm(grad)
-                model.zero_grad()
-
-            model.cell.nfe = 0
-            loss.backward()
-            rec['backward_nfe'] = model.cell.nfe
-            nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            optimizer.step()
-        rec['train_time'] = time.time() - train_start_time
-        if epoch == 0 or (epoch + 1) % 1 == 0:
-            model.cell.nfe = 0
-            predict = model(data.valid_times / 64.0, data.valid_x)
-            vloss = criteria(predict, data.valid_y)
-            rec['va_nfe'] = model.cell.nfe
-            rec['va_loss'] = vloss
-        if epoch == 0 or (epoch + 1) % 20 == 0:
-            model.cell.nfe = 0
-            predict = model(data.test_times / 64.0, data.test_x)
-            sloss = criteria(predict, data.test_y)
-            sloss = sloss.detach().cpu().numpy()
-            rec['ts_nfe'] = model.cell.nfe
-            rec['ts_loss'] = sloss
-        rec.capture(verbose=True)
-        if (epoch + 1) % 20 == 0:
-            torch.save(model, 'output/walker_{}_rnn_{}.mdl'.format(modelname, count_parameters(model)))
-            rec.writecsv('output/walker_{}_rnn_{}.csv'.format(modelname, count_parameters(model)))
+    trainwalker(model, modelname, data, lr_dict, gradrec=gradrec)
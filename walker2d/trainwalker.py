@@ -0,0 +1,67 @@
+from base import *
+from batching import BatchIterator, BucketBatchSampler, gap_difficulty
+from trainer import Task, Trainer, listener_grads
+
+seqlen = 64
+
+
+class WalkerTask(Task):
+    """
+    One step prediction of the walker2d states, times rescaled by 1/64.
+    Validates every epoch, tests every 20 epochs and saves the whole model and the log every 20 epochs.
+    """
+
+    def __init__(self, data, modelname, batchsize=256, gradrec=None):
+        self.data = data
+        self.modelname = modelname
+        self.sampler = BucketBatchSampler(gap_difficulty(data.train_times), batchsize)
+        self.iterator = BatchIterator((data.train_times, data.train_x, data.train_y), sampler=self.sampler)
+        self.gradrec = gradrec
+        self.criteria = nn.MSELoss()
+
+    def loss(self, model, batch, recorder):
+        times, x, y = batch
+        predict = model(times / 64.0, x)
+        loss = self.criteria(predict, y)
+        recorder['loss'] = loss
+
+        # Gradient backprop computation
+        if self.gradrec is not None:
+            lossf = self.criteria(predict[-1], y[-1])
+            for i, norm in enumerate(listener_grads(lossf, model.ode_rnn.h_rnn)):
+                recorder['grad_{}'.format(i)] = norm
+        return loss
+
+    def evaluate(self, model, recorder, epoch):
+        data = self.data
+        model.cell.nfe = 0
+        predict = model(data.valid_times / 64.0, data.valid_x)
+        recorder['va_nfe'] = model.cell.nfe
+        recorder['va_loss'] = self.criteria(predict, data.valid_y)
+        if epoch == 0 or (epoch + 1) % 20 == 0:
+            model.cell.nfe = 0
+            predict = model(data.test_times / 64.0, data.test_x)
+            recorder['ts_nfe'] = model.cell.nfe
+            recorder['ts_loss'] = self.criteria(predict, data.test_y)
+
+    def epoch_end(self, trainer, epoch):
+        if (epoch + 1) % 20 == 0 or trainer.stop:
+            model = trainer.model
+            torch.save(model, 'output/walker_{}_rnn_{}.mdl'.format(self.modelname, count_parameters(model)))
+            trainer.recorder.writecsv('output/walker_{}_rnn_{}.csv'.format(self.modelname, count_parameters(model)))
+
+
+def trainwalker(model, modelname, data, lr_dict, gradrec=None, niter=500, accumulate=1, checkpoint=None,
+                budget=None, regularizer=None):
+    """
+    :param checkpoint: path or Checkpointer of the full training state, resumed from when it exists
+    :param budget: Budget, e.g. Budget(monitor='va_loss', patience=20, max_nfe=10 ** 8)
+    :param regularizer: Regularizer set on model.ode_rnn, e.g. KineticEnergy(0.01), trained with reg_weight 1
+    """
+    print(model.__str__())
+    print('Number of Parameters: {}'.format(count_parameters(model)))
+    if regularizer is not None:
+        model.ode_rnn.set_regularizer(regularizer)
+    task = WalkerTask(data, modelname, gradrec=gradrec)
+    return Trainer(model, task, lr_dict=lr_dict, accumulate=accumulate, checkpoint=checkpoint,
+                   budget=budget, reg_weight=0. if regularizer is None else 1.).fit(niter)